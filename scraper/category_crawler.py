@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+import time
+from urllib.parse import urlparse
+
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
+
+log = logging.getLogger(__name__)
+
+CRAWL_CONCURRENCY_PER_HOST = int(os.environ.get("CRAWL_CONCURRENCY_PER_HOST", "4"))
+CRAWL_TIMEOUT_SECONDS = float(os.environ.get("CRAWL_TIMEOUT_SECONDS", "30"))
+CRAWL_PAGE_SIZE = int(os.environ.get("CRAWL_PAGE_SIZE", "80"))
+# a backstop in case a category keeps serving listings forever
+CRAWL_MAX_PAGES = int(os.environ.get("CRAWL_MAX_PAGES", "200"))
+
+BASE_URL = "https://www.turners.co.nz/"
+CATEGORY_URLS = [
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=convertible",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=wagon",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=utility",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=hatchback",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=van",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=sedan",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=suv",
+    "https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={page_size}&pageno={page}&issearchsimilar=true&types=coupe",
+    # "https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={page_size}&pageno={page}&industry=agriculture",
+    # "https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={page_size}&pageno={page}&industry=construction%2C%20forestry%20%26%20earthmoving",
+    # "https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={page_size}&pageno={page}&industry=industrial",
+    # "https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={page_size}&pageno={page}&industry=lifting%20%26%20material%20handling",
+    # "https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={page_size}&pageno={page}&industry=trailers",
+    # "https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={page_size}&pageno={page}&industry=trucks",
+]
+
+LISTING_LINKS = SoupStrainer("a", attrs={"class": "green"})
+
+
+def listing_urls(html_text: str) -> list[str]:
+    # only the listing links are parsed, the rest of the page is skipped
+    soup = BeautifulSoup(html_text, "html.parser", parse_only=LISTING_LINKS)
+    return [BASE_URL + a["href"] for a in soup.find_all("a", href=True)]
+
+
+class CategoryCrawler:
+    """
+    finds every listing url in the category pages. categories are crawled concurrently, each one page after
+    another until a page comes back with nothing new, and no host sees more than concurrency_per_host requests
+    at once. any page that can't be fetched fails the whole crawl, a partial one would make live stock look stale
+    """
+
+    def __init__(self, category_urls: list[str] = CATEGORY_URLS, page_size: int = CRAWL_PAGE_SIZE,
+                 concurrency_per_host: int = CRAWL_CONCURRENCY_PER_HOST, timeout: float = CRAWL_TIMEOUT_SECONDS,
+                 max_pages: int = CRAWL_MAX_PAGES):
+        self.category_urls = category_urls
+        self.page_size = page_size
+        self.concurrency_per_host = concurrency_per_host
+        self.timeout = timeout
+        self.max_pages = max_pages
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+
+    def host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.concurrency_per_host)
+        return self._host_limits[host]
+
+    async def fetch(self, client: httpx.AsyncClient, url: str) -> str:
+        async with self.host_limit(url):
+            response = await client.get(url)
+        response.raise_for_status()
+        return response.text
+
+    async def crawl_category(self, client: httpx.AsyncClient, category_url: str) -> list[str]:
+        found, seen = [], set()
+        for page in range(1, self.max_pages + 1):
+            urls = listing_urls(await self.fetch(client, category_url.format(page_size=self.page_size, page=page)))
+            new = [url for url in urls if url not in seen]
+            # some listings pages repeat the last page for a page number past the end
+            if not new:
+                break
+            seen.update(new)
+            found.extend(new)
+            if len(urls) < self.page_size:
+                break
+        log.info(f"found {len(found)} listings in {page} pages of {category_url}")
+        return found
+
+    async def crawl(self) -> list[str]:
+        start = time.perf_counter()
+        self._host_limits = {}
+        limits = httpx.Limits(max_connections=self.concurrency_per_host * 2, max_keepalive_connections=self.concurrency_per_host)
+        transport = httpx.AsyncHTTPTransport(retries=2, limits=limits)
+        async with httpx.AsyncClient(transport=transport, timeout=self.timeout, follow_redirects=True) as client:
+            categories = await asyncio.gather(*(self.crawl_category(client, url) for url in self.category_urls))
+
+        # a listing can show up under more than one category, keep the first
+        urls = list(dict.fromkeys(url for category in categories for url in category))
+        log.info(f"discovered {len(urls)} listings in {time.perf_counter() - start:.1f}s")
+        return urls
+
+    def run(self) -> list[str]:
+        return asyncio.run(self.crawl())
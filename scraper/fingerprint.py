@@ -0,0 +1,39 @@
+import hashlib
+import re
+from typing import Optional
+
+from tina.retrievers.listing_digest import clean_page_content
+
+# the price right before the on road costs note, so the final one on a "Was $X You Save $Y $Z" line
+PRICE = re.compile(r"\$([\d,]+(?:\.\d+)?)\s+\*(?:All|Excludes) On Road Costs")
+ODOMETER = re.compile(r"Odometer\s+([\d,]+)\s*km")
+# parts of a listing page that change without the vehicle changing
+VOLATILE = re.compile(r"Autobids can be placed from [\d:]+[ap]m, \d+ \w+ \d{4}|Date & Time\s+\d+ \w+ \d{4}, [\d:]+[ap]m"
+                      r"|Lot [\w ]+/ Lane \d+")
+
+
+def parse_number(pattern: re.Pattern, content: str) -> Optional[float]:
+    match = pattern.search(content)
+    return float(match.group(1).replace(",", "")) if match else None
+
+
+def listing_fingerprint(content: str) -> dict:
+    """a hash of the stable text of a listing page, plus the price and odometer read off it"""
+    stable = VOLATILE.sub(" ", clean_page_content(content))
+    return {
+        "hash": hashlib.sha256(" ".join(stable.split()).encode("utf-8")).hexdigest(),
+        "price": parse_number(PRICE, content),
+        "odometer": parse_number(ODOMETER, content),
+    }
+
+
+def stored_fingerprint(listing: dict) -> dict:
+    """listings stored before fingerprints existed still have the page content to work one out from"""
+    return listing.get("fingerprint") or listing_fingerprint(listing.get("content", ""))
+
+
+def fingerprint_changes(old: dict, new: dict) -> list[str]:
+    changes = [f"{k} {old.get(k)} -> {new.get(k)}" for k in ("price", "odometer") if old.get(k) != new.get(k)]
+    if old.get("hash") != new.get("hash") and not changes:
+        changes.append("content")
+    return changes
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+
+import httpx
+from bs4 import BeautifulSoup
+from langchain_community.document_transformers.beautiful_soup_transformer import get_navigable_strings
+from langchain_core.documents import Document
+
+from scraper.category_crawler import CRAWL_CONCURRENCY_PER_HOST, CRAWL_TIMEOUT_SECONDS
+
+log = logging.getLogger(__name__)
+
+UNWANTED_TAGS = ("script", "style")
+TAGS_TO_EXTRACT = ("p", "li", "div", "a")
+# the gallery photos worth showing the llm
+GALLERY_PHOTO = re.compile(r"Photo '[1,2,4,5]'")
+
+
+@dataclass
+class ListingPage:
+    source: str
+    html: str
+    document: Document
+    image_urls: list[str] = field(default_factory=list)
+
+
+def page_metadata(soup: BeautifulSoup, url: str) -> dict:
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", "No language found.")
+    return metadata
+
+
+def gallery_images(soup: BeautifulSoup) -> list[str]:
+    return [image["data-src"] for image in soup.find_all("img", attrs={"class": "lazyOwl"})
+            if GALLERY_PHOTO.match(image.get("alt", "")) and image.get("data-src")]
+
+
+def page_text(soup: BeautifulSoup) -> str:
+    """
+    the same text BeautifulSoupTransformer gives with its defaults: text from p/li/div/a tags with links as
+    "text (href)" and comments kept, since the content area is found by its "Start: Main Content Area" comment
+    """
+    for tag in UNWANTED_TAGS:
+        for element in soup.find_all(tag):
+            element.decompose()
+
+    text_parts = []
+    for element in soup.find_all():
+        if element.name in TAGS_TO_EXTRACT:
+            text_parts += get_navigable_strings(element)
+            # To avoid duplicate text, remove all descendants from the soup.
+            element.decompose()
+
+    lines = (line.strip() for line in " ".join(text_parts).split("\n"))
+    return " ".join(line for line in lines if line)
+
+
+def parse_listing(url: str, html: str) -> ListingPage:
+    """metadata, gallery images and text from a single parse of the page"""
+    soup = BeautifulSoup(html, "html.parser")
+    metadata = page_metadata(soup, url)
+    # images first, extracting the text takes the page apart
+    image_urls = gallery_images(soup)
+    return ListingPage(source=url, html=html, document=Document(page_content=page_text(soup), metadata=metadata),
+                       image_urls=image_urls)
+
+
+class ListingLoader:
+    """fetches each listing page once over a pooled client, at most concurrency requests at a time"""
+
+    def __init__(self, concurrency: int = CRAWL_CONCURRENCY_PER_HOST, timeout: float = CRAWL_TIMEOUT_SECONDS):
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def load(self, urls: list[str]) -> list[ListingPage]:
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency * 2, max_keepalive_connections=self.concurrency)
+        transport = httpx.AsyncHTTPTransport(retries=2, limits=limits)
+
+        async def fetch(client: httpx.AsyncClient, url: str):
+            try:
+                async with semaphore:
+                    response = await client.get(url)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                log.warning(f"unable to load listing {url}: {e}")
+                return None
+            return parse_listing(url, response.text)
+
+        async with httpx.AsyncClient(transport=transport, timeout=self.timeout, follow_redirects=True) as client:
+            pages = await asyncio.gather(*(fetch(client, url) for url in urls))
+
+        pages = [page for page in pages if page is not None]
+        log.info(f"loaded {len(pages)} of {len(urls)} listings in {time.perf_counter() - start:.1f}s")
+        return pages
+
+    def run(self, urls: list[str]) -> list[ListingPage]:
+        return asyncio.run(self.load(urls))
@@ -0,0 +1,62 @@
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable
+
+log = logging.getLogger(__name__)
+
+
+def is_rate_limited(e: Exception) -> bool:
+    """openai raises RateLimitError, pinecone an api exception carrying a 429 status"""
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+    return status == 429 or "RateLimit" in type(e).__name__ or "Too Many Requests" in str(e)
+
+
+class AdaptiveRateLimiter:
+    """
+    paces calls at a rate that grows a little after every success and halves whenever the provider pushes
+    back (additive increase, multiplicative decrease), so a bulk load settles just under the provider's limit
+    """
+
+    def __init__(self, name: str, rate: float = 2.0, min_rate: float = 0.1, max_rate: float = 50.0,
+                 increase: float = 0.25, max_retries: int = 6):
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.max_retries = max_retries
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._next = time.monotonic() + random.uniform(0.5, 1.5) / self.rate
+        log.info(f"{self.name} rate limited, slowing to {self.rate:.2f} calls/s")
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                self.throttled()
+                continue
+            self.success()
+            return result
@@ -1,59 +1,155 @@
 import asyncio
+import hashlib
+import logging
 import os
 import time
-
-from pinecone import Pinecone
+from collections import Counter
 
 import bs4
-import voyageai
 from langchain_community.document_loaders import WebBaseLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_voyageai import VoyageAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from scraper.rate_limiter import AdaptiveRateLimiter
+from tina.retrievers.embedding_cache import normalise_text
+from tina.retrievers.vector_index import get_vector_index, save_index
 
+log = logging.getLogger(__name__)
 
-async def load_faq_page(page_urls):
+FAQ_INDEX_NAME = os.environ.get("FAQ_INDEX_NAME", "turners-faq")
+# how many items each stage can get ahead of the next one
+FAQ_QUEUE_SIZE = int(os.environ.get("FAQ_QUEUE_SIZE", "4"))
+FAQ_EMBED_BATCH_SIZE = int(os.environ.get("FAQ_EMBED_BATCH_SIZE", "50"))
+FAQ_UPSERT_BATCH_SIZE = int(os.environ.get("FAQ_UPSERT_BATCH_SIZE", "100"))
+# ids go in the query string of a pinecone fetch, so keep the batches short
+FETCH_BATCH_SIZE = 100
 
-    loader = WebBaseLoader(
-        web_paths=page_urls,
-        bs_kwargs = {
-            "parse_only": bs4.SoupStrainer(class_="main"),
-        }
-    )
-    docs = []
-    async for doc in loader.alazy_load():
-        docs.append(doc)
+FAQ_URLS = [
+    "https://www.turners.co.nz/Cars/how-to-buy/how-to-buy-faqs/",
+    "https://www.turners.co.nz/Cars/sell-your-car/selling-your-car-faqs/",
+    "https://www.turners.co.nz/Turners-Live/",
+]
 
-    return docs
 
+def chunk_id(text: str) -> str:
+    """chunks are stored under a hash of their text, so an unchanged chunk keeps its id between runs"""
+    return hashlib.sha256(normalise_text(text).encode()).hexdigest()
 
-vo = voyageai.Client()
-pinecone = Pinecone(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT_REGION"])
-embeddings = VoyageAIEmbeddings(voyage_api_key=os.environ["VOYAGE_API_KEY"], model="voyage-3-large", batch_size=50, output_dimension=2048)
 
-docs = asyncio.run(load_faq_page([
-    "https://www.turners.co.nz/Cars/how-to-buy/how-to-buy-faqs/",
-    "https://www.turners.co.nz/Cars/sell-your-car/selling-your-car-faqs/",
-    "https://www.turners.co.nz/Turners-Live/"
-]))
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=500,
-    chunk_overlap=0,
-    separators=["\n\n\n"]
-)
-
-vector_store = PineconeVectorStore(
-    index_name="turners-faq",
-    embedding=embeddings
-)
-
-for doc in docs:
-    texts = text_splitter.create_documents([doc.page_content])
-    BATCH_SIZE = 50
-    for i in range(0, len(texts), BATCH_SIZE):
-        batch_docs = texts[i:i + BATCH_SIZE]
-        vector_store.add_documents(batch_docs)
-        time.sleep(0.5)
-
-print("All documents processed successfully!")
\ No newline at end of file
+def faq_embeddings() -> VoyageAIEmbeddings:
+    return VoyageAIEmbeddings(voyage_api_key=os.environ["VOYAGE_API_KEY"], model="voyage-3-large", batch_size=FAQ_EMBED_BATCH_SIZE,
+                              output_dimension=2048)
+
+
+class FaqIngestion:
+    """
+    loads, splits, embeds and upserts the faq pages as a pipeline of stages joined by bounded queues, so a page
+    is being embedded while the next one is split. chunks already in the index are skipped, and once every page
+    has been through, chunks that are no longer on any page are removed
+    """
+
+    def __init__(self, index, embeddings, urls: list[str] = FAQ_URLS, queue_size: int = FAQ_QUEUE_SIZE,
+                 embed_batch_size: int = FAQ_EMBED_BATCH_SIZE, upsert_batch_size: int = FAQ_UPSERT_BATCH_SIZE):
+        self.index = index
+        self.embeddings = embeddings
+        self.urls = urls
+        self.queue_size = queue_size
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0, separators=["\n\n\n"])
+        self.embed_limiter = AdaptiveRateLimiter("faq embeddings", rate=2.0)
+        self.upsert_limiter = AdaptiveRateLimiter("faq upserts", rate=5.0)
+        self.seen: set[str] = set()
+        self.stats = Counter()
+
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        existing = set()
+        for i in range(0, len(ids), FETCH_BATCH_SIZE):
+            response = self.index.fetch(ids=ids[i:i + FETCH_BATCH_SIZE])
+            vectors = response["vectors"] if isinstance(response, dict) else response.vectors
+            existing.update(vectors)
+        return existing
+
+    async def load(self, pages: asyncio.Queue):
+        loader = WebBaseLoader(web_paths=self.urls, bs_kwargs={"parse_only": bs4.SoupStrainer(class_="main")})
+        async for doc in loader.alazy_load():
+            self.stats["pages"] += 1
+            await pages.put(doc)
+        await pages.put(None)
+
+    async def split(self, pages: asyncio.Queue, batches: asyncio.Queue):
+        batch = []
+        while (doc := await pages.get()) is not None:
+            chunks = {}
+            for chunk in self.splitter.split_documents([doc]):
+                # the same text can turn up on more than one page, it only needs storing once
+                id_ = chunk_id(chunk.page_content)
+                if id_ not in self.seen:
+                    self.seen.add(id_)
+                    chunks[id_] = chunk
+            existing = await asyncio.to_thread(self.existing_ids, list(chunks))
+            self.stats["chunks"] += len(chunks)
+            self.stats["unchanged"] += len(existing)
+
+            for id_, chunk in chunks.items():
+                if id_ in existing:
+                    continue
+                batch.append((id_, chunk))
+                if len(batch) == self.embed_batch_size:
+                    await batches.put(batch)
+                    batch = []
+        if batch:
+            await batches.put(batch)
+        await batches.put(None)
+
+    async def embed(self, batches: asyncio.Queue, records: asyncio.Queue):
+        while (batch := await batches.get()) is not None:
+            vectors = await asyncio.to_thread(self.embed_limiter.call, self.embeddings.embed_documents,
+                                              [chunk.page_content for _, chunk in batch])
+            # keep the chunk under "text" like PineconeVectorStore does so the retriever can read it
+            await records.put([
+                {"id": id_, "values": vector, "metadata": {**chunk.metadata, "text": chunk.page_content}}
+                for (id_, chunk), vector in zip(batch, vectors)
+            ])
+        await records.put(None)
+
+    async def upsert(self, records: asyncio.Queue):
+        while (batch := await records.get()) is not None:
+            for i in range(0, len(batch), self.upsert_batch_size):
+                await asyncio.to_thread(self.upsert_limiter.call, self.index.upsert,
+                                        vectors=batch[i:i + self.upsert_batch_size])
+            self.stats["upserted"] += len(batch)
+
+    def prune(self):
+        stale = [id_ for ids in self.index.list(prefix="") for id_ in ids if id_ not in self.seen]
+        for i in range(0, len(stale), 1000):
+            self.upsert_limiter.call(self.index.delete, ids=stale[i:i + 1000])
+        self.stats["removed"] = len(stale)
+
+    async def run(self) -> dict:
+        start = time.perf_counter()
+        self.seen, self.stats = set(), Counter()
+        pages, batches, records = (asyncio.Queue(maxsize=self.queue_size) for _ in range(3))
+
+        # a failing stage cancels the rest, so nothing is left waiting on a queue that will never fill
+        async with asyncio.TaskGroup() as stages:
+            stages.create_task(self.load(pages))
+            stages.create_task(self.split(pages, batches))
+            stages.create_task(self.embed(batches, records))
+            stages.create_task(self.upsert(records))
+
+        # only reached when every page loaded, a partial run would make live chunks look stale
+        await asyncio.to_thread(self.prune)
+        await asyncio.to_thread(save_index, self.index)
+        log.info(f"faq ingestion took {time.perf_counter() - start:.1f}s: {dict(self.stats)}")
+        return dict(self.stats)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    ingestion = FaqIngestion(get_vector_index(FAQ_INDEX_NAME), faq_embeddings())
+    asyncio.run(ingestion.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,45 @@
+import asyncio
+import time
 from json import JSONDecodeError
-from typing import Sequence
+from typing import Callable, Optional
 
-import requests
-import re
-
-from bs4 import BeautifulSoup
 from langchain.chat_models import init_chat_model
-from langchain_community.document_loaders import AsyncHtmlLoader
-from langchain_community.document_transformers import BeautifulSoupTransformer
 from langchain_core.documents import Document
 from langchain_core.utils.json import parse_json_markdown
 from langchain_core.prompts import PromptTemplate
+from langchain_core.exceptions import OutputParserException
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_openai import OpenAI
 from pydantic import ValidationError
-from tinydb import TinyDB, Query
 
+from scraper.category_crawler import CategoryCrawler
+from scraper.fingerprint import fingerprint_changes, listing_fingerprint, stored_fingerprint
+from scraper.listing_loader import ListingLoader, ListingPage
 from scraper.vector_db import VectorDB
 from scraper.vehicle_listing import VehicleListing
+from tina.retrievers.facet_catalogue import load_facet_catalogue, save_facet_catalogue
+from tina.retrievers.listing_digest import build_digest, digest_for
+from tina.retrievers.listing_repository import listing_repository
 
 import logging
+import os
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# "incremental" refetches known listings and re-enriches the ones whose fingerprint changed, "new" only adds unseen ones
+CRAWL_MODE = os.environ.get("CRAWL_MODE", "incremental")
+ENRICH_CONCURRENCY = int(os.environ.get("ENRICH_CONCURRENCY", "8"))
+ENRICH_PROGRESS_EVERY = 10
+# enriched listings are stored in batches of this many as they finish, so a failed run keeps what it did
+ENRICH_STORE_EVERY = int(os.environ.get("ENRICH_STORE_EVERY", "20"))
+
 
 class TurnersScraper:
     chat = init_chat_model("gpt-4o", model_provider="openai")
 
     parser = JsonOutputParser(pydantic_object=VehicleListing)
     vector_store = VectorDB()
-    db = TinyDB('db/db.json')
+    db = listing_repository
 
     @staticmethod
     def filter_content(docs_transformed):
@@ -39,76 +49,101 @@ class TurnersScraper:
             if "End: Main Content Area" in d.page_content:
                 d.page_content = d.page_content.split('End: Main Content Area')[0]
 
-    def run_crawler(self):
-        max_count = 80
-
-        vgm_urls = [
-            f'https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=convertible',
-            f'https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=wagon',
-            f'https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=utility',
-            f'https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=hatchback',
-            f'https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=van',
-            f"https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=sedan",
-            f"https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=suv",
-            f"https://www.turners.co.nz/Cars/Used-Cars-for-Sale/?sortorder=7&pagesize={max_count}&pageno=1&issearchsimilar=true&types=coupe",
-            # f'https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={max_count}&pageno=1&industry=agriculture',
-            # f'https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={max_count}&pageno=1&industry=construction%2C%20forestry%20%26%20earthmoving',
-            # f'https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={max_count}&pageno=1&industry=industrial',
-            # f'https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={max_count}&pageno=1&industry=lifting%20%26%20material%20handling',
-            # f"https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={max_count}&pageno=1&industry=trailers",
-            # f"https://www.turners.co.nz/Trucks-Machinery/Used-Trucks-and-Machinery-for-Sale/?sortorder=0&pagesize={max_count}&pageno=1&industry=trucks"
-        ]
-
-        urls = []
-
-        for vgm_url in vgm_urls:
-            html_text = requests.get(vgm_url).text
-            soup = BeautifulSoup(html_text, 'html5lib')
-            attrs = {
-                'class': "green"
-            }
-            for listing in soup.find_all('a', attrs=attrs):
-                urls.append("https://www.turners.co.nz/"+listing['href'])
+    def run_crawler(self, mode: str = CRAWL_MODE):
+        urls = CategoryCrawler().run()
+        live = set(urls)
 
-        stale = [doc for doc in self.db.all() if doc['source'] not in urls]
-        q = Query()
+        self.migrate_vector_ids()
+        facets = load_facet_catalogue()
+        stale = [doc for doc in self.db.all() if doc['source'] not in live]
+        # vectors first, a failed delete leaves the records to find the vectors by on the next run
+        self.vector_store.delete_many(stale)
         for doc in stale:
             log.info(f"removing stale listing:{doc['source']}")
-            self.db.remove(q.source == doc['source'])
-            self.vector_store.delete(doc)
+            self.db.remove(doc['source'])
+            facets.remove(doc)
+
+        known = self.db.sources()
+        if mode != "incremental":
+            urls = [url for url in urls if url not in known]
+
+        pages = TurnersScraper.extract_data(urls)
+        log.info(f"loaded {len(pages)} documents")
+
+        unchanged, to_enrich, backfill = 0, [], {}
+        for page in pages:
+            fingerprint = listing_fingerprint(page.document.page_content)
+            existing = self.db.get(page.source) if page.source in known else None
+            if existing is not None:
+                changes = fingerprint_changes(stored_fingerprint(existing), fingerprint)
+                if not changes:
+                    unchanged += 1
+                    if not (existing.get('digest') and existing.get('fingerprint')):
+                        backfill[page.source] = {'digest': digest_for(existing), 'fingerprint': fingerprint}
+                    continue
+                log.info(f"listing changed ({', '.join(changes)}): {page.source}")
+            to_enrich.append((page, fingerprint, existing))
 
-        urls = [url for url in urls if len(self.db.search(q.source == url)) == 0]
+        # listings stored before digests and fingerprints existed get them without another trip through the llm
+        if backfill:
+            self.db.update_many(backfill)
+            log.info(f"backfilled the digest and fingerprint of {len(backfill)} unchanged listings")
 
-        docs_transformed = TurnersScraper.extract_data(urls)
-        log.info(f"loaded {len(docs_transformed)} documents")
+        pending = {page.source: (fingerprint, existing) for page, fingerprint, existing in to_enrich}
 
-        for doc in docs_transformed:
-            try:
-                listing = self.append_data_from_images(doc)
-                self.vector_store.save(listing, doc)
-                self.db.insert({
-                    'source': doc.metadata['source'],
-                    'image': doc.metadata['image'],
-                    'content': doc.page_content,
-                    'metadata': doc.metadata,
-                })
+        def store(batch: list[tuple[ListingPage, VehicleListing]]):
+            self.store_listings([(page, listing, *pending[page.source]) for page, listing in batch], facets)
 
-            except (ValidationError, JSONDecodeError) as e:
-                print(e)
+        listings = asyncio.run(self.enrich([page for page, _, _ in to_enrich], store=store))
+
+        log.info(f"{len(stale)} stale, {unchanged} unchanged, {len(listings)} of {len(to_enrich)} new or changed listings enriched")
+        save_facet_catalogue(facets)
+
+    def migrate_vector_ids(self):
+        """
+        record the ids of the vectors stored before ids were deterministic, so they can be deleted by id like the
+        rest. runs once, a single sweep of the index, and does nothing after every listing has its vector_ids
+        """
+        missing = {doc['source'] for doc in self.db.all() if 'vector_ids' not in doc}
+        if not missing:
+            return
+        found = self.vector_store.legacy_ids(missing)
+        # a listing with no legacy vectors must already be under the deterministic ids
+        self.db.update_many({source: {'vector_ids': found.get(source) or VectorDB.vector_ids(source)} for source in missing})
+        log.info(f"recorded vector ids for {len(missing)} listings, {len(found)} with legacy ids")
+
+    def store_listings(self, enriched: list[tuple[ListingPage, VehicleListing, dict, Optional[dict]]], facets):
+        """upsert the vectors of a batch of enriched listings, then write their records and facets"""
+        # saving overwrites the vectors of changed listings, apart from any stored before ids were deterministic
+        self.vector_store.delete_outdated([existing for _, _, _, existing in enriched if existing is not None])
+        self.vector_store.save_many([(listing, page.document) for page, listing, _, _ in enriched])
+
+        for page, listing, fingerprint, existing in enriched:
+            doc, source = page.document, page.source
+            if existing is not None:
+                self.db.remove(source)
+                facets.remove(existing)
+            record = {
+                'source': source,
+                'image': doc.metadata['image'],
+                'content': doc.page_content,
+                'metadata': doc.metadata,
+                'digest': build_digest(listing.model_dump(), doc.metadata, source, doc.metadata.get('image')),
+                'fingerprint': fingerprint,
+                'vector_ids': VectorDB.vector_ids(source),
+            }
+            self.db.insert(record)
+            facets.add(record)
+        save_facet_catalogue(facets)
 
     @staticmethod
-    def extract_data(urls: list[str]) -> Sequence[Document]:
-        loader = AsyncHtmlLoader(urls, default_parser="html5lib")
-        data = loader.load()
-        html2text = BeautifulSoupTransformer()
-        docs_transformed = html2text.transform_documents(data)
-        TurnersScraper.filter_content(docs_transformed)
+    def extract_data(urls: list[str]) -> list[ListingPage]:
+        pages = ListingLoader().run(urls)
+        TurnersScraper.filter_content([page.document for page in pages])
 
-        return docs_transformed
+        return pages
 
-    def append_data_from_images(self, doc: Document) -> VehicleListing:
-        log.info(doc.metadata)
-        template = """Please provide a JSON response in the following format to the question provided, mark the json as ```json:
+    section_template = """Please provide a JSON response in the following format to the question provided, mark the json as ```json:
             {format_instructions}
             ---
             Question:
@@ -119,17 +154,7 @@ class TurnersScraper:
             {page_content}
             """
 
-        prompt = PromptTemplate(
-            template=template,
-            input_variables=["page_content"],
-            partial_variables={"format_instructions": self.parser.get_format_instructions()}
-        )
-        chain = prompt | self.chat
-        output_from_claude = chain.invoke({"page_content": doc.page_content})
-        markdown = parse_json_markdown(output_from_claude.content)
-        listing = VehicleListing.model_validate(markdown)
-
-        template = """Please provide a JSON response in the following format to the question provided, mark the json as ```json:
+    image_template = """Please provide a JSON response in the following format to the question provided, mark the json as ```json:
             {format_instructions}
             ---
             Question:
@@ -143,34 +168,25 @@ class TurnersScraper:
             Images:
             {images}
             """
+
+    def section_chain(self):
         prompt = PromptTemplate(
-            template=template,
-            input_variables=["page_content", "images"],
+            template=self.section_template,
+            input_variables=["page_content"],
             partial_variables={"format_instructions": self.parser.get_format_instructions()}
         )
-        chain = prompt | self.chat
-
-        html_text = requests.get(doc.metadata['source']).text
-        soup = BeautifulSoup(html_text, 'html5lib')
-
-        attrs = {
-            'class': "lazyOwl"
-        }
-
-        image_urls = []
-        for image in soup.find_all('img', attrs=attrs):
-            pattern = r"Photo '[1,2,4,5]'"
-            match = re.match(pattern, image['alt'])
-            if match:
-                log.info(image['data-src'])
-                image_urls.append(image['data-src'])
+        return prompt | self.chat
 
-        output_from_claude = chain.invoke({
-            "page_content": listing.model_dump_json(),
-            "images": image_urls
-        })
-        parsed_json = parse_json_markdown(output_from_claude.content)
+    def image_chain(self):
+        prompt = PromptTemplate(
+            template=self.image_template,
+            input_variables=["page_content", "images"],
+            partial_variables={"format_instructions": self.parser.get_format_instructions()}
+        )
+        return prompt | self.chat
 
+    @staticmethod
+    def merge_image_details(listing: VehicleListing, parsed_json: dict, image_urls: list[str]) -> VehicleListing:
         log.info("image enrichment complete")
         log.info(parsed_json)
 
@@ -189,6 +205,71 @@ class TurnersScraper:
 
         return listing
 
+    def append_data_from_images(self, doc: Document, image_urls: list[str]) -> VehicleListing:
+        log.info(doc.metadata)
+        output_from_claude = self.section_chain().invoke({"page_content": doc.page_content})
+        listing = VehicleListing.model_validate(parse_json_markdown(output_from_claude.content))
+
+        log.info(f"images: {image_urls}")
+        output_from_claude = self.image_chain().invoke({
+            "page_content": listing.model_dump_json(),
+            "images": image_urls
+        })
+        return self.merge_image_details(listing, parse_json_markdown(output_from_claude.content), image_urls)
+
+    async def aappend_data_from_images(self, doc: Document, image_urls: list[str]) -> VehicleListing:
+        output_from_claude = await self.section_chain().ainvoke({"page_content": doc.page_content})
+        listing = VehicleListing.model_validate(parse_json_markdown(output_from_claude.content))
+
+        output_from_claude = await self.image_chain().ainvoke({
+            "page_content": listing.model_dump_json(),
+            "images": image_urls
+        })
+        return self.merge_image_details(listing, parse_json_markdown(output_from_claude.content), image_urls)
+
+    async def enrich(self, pages: list[ListingPage], concurrency: int = ENRICH_CONCURRENCY,
+                     store: Optional[Callable[[list[tuple[ListingPage, VehicleListing]]], None]] = None,
+                     store_every: int = ENRICH_STORE_EVERY) -> dict[str, VehicleListing]:
+        """
+        section and image-enrich listings, concurrency at a time. a listing that fails, whether the llm gives bad
+        json or the api errors, is logged and left out without holding up the rest. finished listings are handed
+        to store in batches of store_every, one batch at a time, so they are kept even if the run dies later
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        store_lock = asyncio.Lock()
+        listings, failed, ready = {}, [], []
+        start = time.perf_counter()
+
+        async def flush(size: int):
+            nonlocal ready
+            if store is None or not ready or len(ready) < size:
+                return
+            batch, ready = ready, []
+            async with store_lock:
+                await asyncio.to_thread(store, batch)
+
+        async def enrich_one(page: ListingPage):
+            async with semaphore:
+                try:
+                    listings[page.source] = await self.aappend_data_from_images(page.document, page.image_urls)
+                    ready.append((page, listings[page.source]))
+                except (ValidationError, JSONDecodeError, OutputParserException) as e:
+                    log.warning(f"unable to enrich {page.source}: {e}")
+                    failed.append(page.source)
+                except Exception as e:
+                    log.warning(f"unable to enrich {page.source}: {type(e).__name__}: {e}")
+                    failed.append(page.source)
+            done = len(listings) + len(failed)
+            if done % ENRICH_PROGRESS_EVERY == 0 or done == len(pages):
+                elapsed = time.perf_counter() - start
+                log.info(f"enriched {done}/{len(pages)} listings, {len(failed)} failed, "
+                         f"{done / elapsed:.2f} listings/s, {elapsed:.0f}s elapsed")
+            await flush(store_every)
+
+        await asyncio.gather(*(enrich_one(page) for page in pages))
+        await flush(1)
+        return listings
+
 
 if __name__ == "__main__":
     print("hello turners langchain")
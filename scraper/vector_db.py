@@ -1,49 +1,115 @@
 import os
-import time
-
-import uuid
 import copy
+import re
 
 from langchain_core.documents import Document
-from langchain_openai import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
 
+from scraper.rate_limiter import AdaptiveRateLimiter
 from scraper.vehicle_listing import VehicleListing
-from pinecone import Pinecone
+from tina.retrievers.embedding_cache import cached_embeddings
+from tina.retrievers.vector_index import get_vector_index, save_index
+import logging
 import multiprocessing
 # Force the 'spawn' method which is more compatible
 multiprocessing.set_start_method('spawn', force=True)
 
+log = logging.getLogger(__name__)
+
+# openai takes up to 2048 inputs per embedding request, pinecone recommends upserts of about 100 vectors
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "1000"))
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", "100"))
+# the most ids pinecone accepts in one delete
+DELETE_BATCH_SIZE = 1000
+# before ids were deterministic a listing's vectors were stored under its source with a uuid4 appended
+LEGACY_ID_SUFFIX = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}")
+
+
 class VectorDB:
 
-    pinecone = Pinecone(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT_REGION"])
-    index = pinecone.Index("turners-sample-stock")
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large", dimensions=2048)
+    index = get_vector_index("turners-sample-stock")
+    embeddings = cached_embeddings(model="text-embedding-3-large", dimensions=2048)
+    embed_limiter = AdaptiveRateLimiter("embeddings", rate=1.0)
+    upsert_limiter = AdaptiveRateLimiter("upserts", rate=5.0)
+
+    sections = ("manufacturer_details", "feature_details", "condition_details", "possible_uses", "other")
 
     def __init__(self):
         pass
 
-    def save(self, listing: VehicleListing, doc: Document):
+    @staticmethod
+    def vector_ids(source: str) -> list[str]:
+        """one vector per listing section, so saving a listing again overwrites it rather than adding to it"""
+        return [f"{source}#{section}" for section in VectorDB.sections]
+
+    @staticmethod
+    def section_documents(listing: VehicleListing, doc: Document) -> list[Document]:
         doc.metadata.update(listing.metadata.dict(exclude_none=True))
 
-        docs = [
-            Document(page_content=listing.manufacturer_details, metadata=copy.deepcopy(doc.metadata)),
-            Document(page_content=listing.feature_details, metadata=copy.deepcopy(doc.metadata)),
-            Document(page_content=listing.condition_details, metadata=copy.deepcopy(doc.metadata)),
-            Document(page_content=listing.possible_uses, metadata=copy.deepcopy(doc.metadata)),
-            Document(page_content=listing.other, metadata=copy.deepcopy(doc.metadata))
+        return [
+            Document(page_content=getattr(listing, section), metadata=copy.deepcopy(doc.metadata))
+            for section in VectorDB.sections
         ]
-        ids = [doc.metadata['source'] + str(uuid.uuid4()) for doc in docs]
-
-        BATCH_SIZE = 50
-        for i in range(0, len(docs), BATCH_SIZE):
-            batch_docs = docs[i:i + BATCH_SIZE]
-            batch_ids = ids[i:i + BATCH_SIZE]
-            PineconeVectorStore.from_documents(batch_docs, index_name="turners-sample-stock", embedding=self.embeddings,
-                                               ids=batch_ids)
-            time.sleep(0.5)
-
-    def delete(self, doc: Document):
-        for ids in self.index.list(prefix=doc['source']):
-            print(ids)  # ['doc1#chunk1', 'doc1#chunk2', 'doc1#chunk3']
-            self.index.delete(ids=ids)
+
+    def save(self, listing: VehicleListing, doc: Document):
+        self.save_many([(listing, doc)])
+
+    def save_many(self, listings: list[tuple[VehicleListing, Document]]):
+        """embed and upsert the sections of many listings together, in as few requests as the providers allow"""
+        docs = [section for listing, doc in listings for section in self.section_documents(listing, doc)]
+        ids = [id_ for _, doc in listings for id_ in self.vector_ids(doc.metadata['source'])]
+
+        vectors = []
+        for i in range(0, len(docs), EMBED_BATCH_SIZE):
+            batch = [d.page_content for d in docs[i:i + EMBED_BATCH_SIZE]]
+            vectors += self.embed_limiter.call(self.embeddings.embed_documents, batch)
+        log.info(f"embedded {len(docs)} sections from {len(listings)} listings, cache: {self.embeddings.stats()}")
+
+        # keep the page content under "text" like PineconeVectorStore does so either reader works
+        records = [
+            {"id": id_, "values": vector, "metadata": {**d.metadata, "text": d.page_content}}
+            for id_, vector, d in zip(ids, vectors, docs)
+        ]
+        for i in range(0, len(records), UPSERT_BATCH_SIZE):
+            self.upsert_limiter.call(self.index.upsert, vectors=records[i:i + UPSERT_BATCH_SIZE])
+        save_index(self.index)
+        log.info(f"upserted {len(records)} vectors")
+
+    @staticmethod
+    def stored_ids(listing: dict) -> list[str]:
+        """the ids a listing record says its vectors are under, the deterministic ones if it predates recording them"""
+        return listing.get('vector_ids') or VectorDB.vector_ids(listing['source'])
+
+    def delete(self, doc: dict):
+        self.delete_many([doc])
+
+    def delete_ids(self, ids: list[str]):
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            self.upsert_limiter.call(self.index.delete, ids=ids[i:i + DELETE_BATCH_SIZE])
+        save_index(self.index)
+
+    def delete_many(self, listings: list[dict]):
+        """remove the vectors of many listings, in batches of ids with no listing round trips"""
+        self.delete_ids([id_ for listing in listings for id_ in self.stored_ids(listing)])
+        log.info(f"deleted vectors for {len(listings)} listings")
+
+    def delete_outdated(self, listings: list[dict]):
+        """remove the vectors of listings about to be saved again that the save won't overwrite, ie legacy ones"""
+        ids = []
+        for listing in listings:
+            current = set(self.vector_ids(listing['source']))
+            ids += [id_ for id_ in self.stored_ids(listing) if id_ not in current]
+        if ids:
+            self.delete_ids(ids)
+
+    def legacy_ids(self, sources: set[str]) -> dict[str, list[str]]:
+        """
+        the uuid suffixed ids of each listing, found in one sweep of the index. only an id that is exactly a known
+        source followed by a uuid counts, so ".../123" never claims the vectors of ".../1234"
+        """
+        found = {}
+        for ids in self.index.list(prefix=""):
+            for id_ in ids:
+                source, suffix = id_[:-36], id_[-36:]
+                if source in sources and LEGACY_ID_SUFFIX.fullmatch(suffix):
+                    found.setdefault(source, []).append(id_)
+        return found
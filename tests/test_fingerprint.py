@@ -0,0 +1,21 @@
+import pytest
+
+from scraper.fingerprint import listing_fingerprint
+
+ODOMETER = "   Odometer   80,440 km   "
+
+
+@pytest.mark.parametrize("content, price", [
+    ("BuyNow   $10,750     *All On Road Costs included      BuyNow", 10750.0),
+    ("BuyNow   Was $10,990  You Save $2,610   $8,380     *All On Road Costs included", 8380.0),
+    ("BuyNow   $22,900     *Excludes On Road Costs of $495 & Tyre Levy", 22900.0),
+    ("BuyNow   Was $14,500  You Save $500   $14,000     *Excludes On Road Costs of $495 & Tyre Levy", 14000.0),
+    ("BuyNow   Was $17,800  You Save -$145   $17,945     *All On Road Costs included", 17945.0),
+    ("View Live Auction   Want Finance?", None),
+])
+def test_price(content, price):
+    assert listing_fingerprint(content + ODOMETER)["price"] == price
+
+
+def test_odometer():
+    assert listing_fingerprint("BuyNow   $10,750     *All On Road Costs included" + ODOMETER)["odometer"] == 80440.0
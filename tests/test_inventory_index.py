@@ -0,0 +1,26 @@
+import pytest
+
+from tina.retrievers.inventory_index import parse_option_bound
+
+
+@pytest.mark.parametrize("label, bound", [
+    ("30,000 kms", 30_000),
+    ("30,000kms", 30_000),
+    ("30000kms", 30_000),
+    ("30000 km", 30_000),
+    ("30k kms", 30_000),
+    ("$5k", 5_000),
+    ("$12,500", 12_500),
+    ("$1.5m", 1_500_000),
+    ("2015", 2015),
+    ("Any kms", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_option_bound(label, bound):
+    assert parse_option_bound(label) == bound
+
+
+def test_parse_option_bound_rejects_text():
+    with pytest.raises(ValueError):
+        parse_option_bound("lots")
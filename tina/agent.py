@@ -1,22 +1,25 @@
+import asyncio
 from datetime import datetime
-from typing import TypedDict, Annotated, Sequence
+from typing import TypedDict, Annotated, Optional, Sequence
 
 from langchain.chat_models import init_chat_model
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import AIMessage, BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
 from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.constants import END
 from langgraph.graph import StateGraph, add_messages
 import logging
-import sqlite3
 
+from tina.checkpointer import sqlite_checkpointer
+from tina.message_history import history_window
 from tina.model.user_profile import UserProfile
+from tina.profile_service import profile_service
+from tina.resilience import ASSISTANT_TIMEOUT_SECONDS, EmptyResponse, ResilientCall, assistant_latency
+from tina.retrievers.search_criteria import update_criteria
 from tina.tools.ask_human import AskHuman
 from tina.tools.book_a_test_drive import book_a_test_drive_tool
 from tina.tools.clarifing_questions import clarifying_question_tool
-from tina.tools.fetch_user_information import fetch_user_information_tool
 from tina.tools.request_callback import request_callback_tool
 from tina.tools.structured_search import structured_search_options_tool, structured_search_tool
 from tina.tools.turners_geography import turners_geography_tool
@@ -27,33 +30,58 @@ from utils import create_tool_node_with_fallback, has_results_to_show
 
 log = logging.getLogger(__name__)
 
+# what the user sees when every attempt came back empty
+NO_RESPONSE = "Sorry, I lost my train of thought there. Could you say that again?"
+
 
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
-    structured_search: dict
+    search_criteria: dict
+    summary: str
+    user_info: Optional[dict]
 
 
 class VirtualTina:
     def __init__(self, runnable: Runnable):
         self.runnable = runnable
+        self.call = ResilientCall(runnable, is_empty=self.is_empty, on_empty=self.nudge)
+
+    @staticmethod
+    def is_empty(result) -> bool:
+        return not result.tool_calls and (
+            not result.content
+            or isinstance(result.content, list)
+            and not result.content[0].get('text')
+        )
+
+    @staticmethod
+    def nudge(state: AgentState) -> AgentState:
+        return {**state, "messages": state['messages'] + [("user", "Respond with a real output.")]}
+
+    @staticmethod
+    def prepare(state: AgentState) -> AgentState:
+        user = state.get("user_info", None)
+        return {**state, "user_info": user, "summary": state.get("summary") or "none, this is the start of the conversation"}
 
     def __call__(self, state: AgentState, config: RunnableConfig):
-        while True:
-            user = state.get("user_info", None)
-            state = {**state, "user_info": user}
-            result = self.runnable.invoke(state)
-
-            if not result.tool_calls and (
-                not result.content
-                or isinstance(result.content, list)
-                and not result.content[0].get('text')
-            ):
-                messages = state['messages'] + [("user", "Respond with a real output.")]
-                state = {**state, "messages": messages}
-            else:
-                break
+        try:
+            result = self.call.invoke(self.prepare(state), config)
+        except EmptyResponse:
+            result = AIMessage(content=NO_RESPONSE)
+        log.info(f"assistant latency: {assistant_latency.stats()}")
+        return {"messages": result}
+
+    async def acall(self, state: AgentState, config: RunnableConfig):
+        try:
+            result = await self.call.ainvoke(self.prepare(state), config)
+        except EmptyResponse:
+            result = AIMessage(content=NO_RESPONSE)
+        log.info(f"assistant latency: {assistant_latency.stats()}")
         return {"messages": result}
 
+    def as_runnable(self) -> Runnable:
+        return RunnableLambda(self.__call__, afunc=self.acall, name="assistant")
+
 
 # Define the config
 class GraphConfig(TypedDict):
@@ -61,7 +89,8 @@ class GraphConfig(TypedDict):
     user_id: str
 
 
-llm = init_chat_model("gpt-4o", model_provider="openai")
+# ResilientCall retries, and the request timeout frees the worker of an attempt it has given up on
+llm = init_chat_model("gpt-4o", model_provider="openai", timeout=ASSISTANT_TIMEOUT_SECONDS, max_retries=0)
 
 
 assistant_prompt = ChatPromptTemplate.from_messages(
@@ -76,6 +105,7 @@ assistant_prompt = ChatPromptTemplate.from_messages(
             "Instead of saying no suitable cars found, use the request_callback tool to to get a human sales rep to call the user back"
             "Use the ask_human tool when a tool requires input or confirmation from the user do NOT guess, ask for all the required information at once. "
             "\n\nCurrent user:\n<User>\n{user_info}\n</User>"
+            "\n\nSummary of the conversation before the messages below:\n<Summary>\n{summary}\n</Summary>"
             "\nCurrent time: {time}.",
         ),
         ("placeholder", "{messages}"),
@@ -115,15 +145,50 @@ def should_continue(state):
         return "continue"
 
 
-def user_info(state: AgentState):
-    return {"user_info": fetch_user_information_tool.invoke({})}
+def fold_search_criteria(state: AgentState):
+    return {"search_criteria": update_criteria(state.get("search_criteria"), state["messages"])}
+
+
+async def afold_search_criteria(state: AgentState):
+    # folding is mostly regex work, the odd llm fallback is sync so it runs on a worker thread
+    return {"search_criteria": await asyncio.to_thread(update_criteria, state.get("search_criteria"), state["messages"])}
+
+
+def compact_history(state: AgentState):
+    # tools inject the summary from state, so it has to exist even before anything has been folded into it
+    return {"summary": state.get("summary") or "", **history_window(state["messages"], state.get("summary"))}
+
+
+async def acompact_history(state: AgentState):
+    return {"summary": state.get("summary") or "", **await history_window.acall(state["messages"], state.get("summary"))}
+
+
+def profile_update(state: AgentState, profile: Optional[UserProfile]) -> dict:
+    """the user_info update, if the profile has moved on from the copy in state (a tool may have changed it)"""
+    user_info = profile.model_dump() if profile is not None else None
+    if "user_info" in state and state["user_info"] == user_info:
+        return {}
+    return {"user_info": user_info}
+
+
+def user_info(state: AgentState, config: RunnableConfig):
+    user_id = config.get("configurable", {}).get("user_id")
+    return profile_update(state, profile_service.get(user_id) if user_id else None)
+
+
+async def auser_info(state: AgentState, config: RunnableConfig):
+    user_id = config.get("configurable", {}).get("user_id")
+    return profile_update(state, await profile_service.aget(user_id) if user_id else None)
 
 
 # Define a new graph
 workflow = StateGraph(AgentState, config_schema=GraphConfig)
 assistant_runnable = assistant_prompt | llm.bind_tools(tools + [AskHuman])
-workflow.set_entry_point("assistant")
-workflow.add_node("assistant", VirtualTina(assistant_runnable))
+workflow.set_entry_point("load_user_info")
+workflow.add_node("load_user_info", RunnableLambda(user_info, afunc=auser_info))
+workflow.add_node("fold_search_criteria", RunnableLambda(fold_search_criteria, afunc=afold_search_criteria))
+workflow.add_node("compact_history", RunnableLambda(compact_history, afunc=acompact_history))
+workflow.add_node("assistant", VirtualTina(assistant_runnable).as_runnable())
 workflow.add_node("tools", create_tool_node_with_fallback(tools))
 workflow.add_node("ask_human", ask_human)
 
@@ -136,12 +201,14 @@ workflow.add_conditional_edges(
         "end": END,
     },
 )
+workflow.add_edge("fold_search_criteria", "compact_history")
+workflow.add_edge("compact_history", "assistant")
 workflow.add_edge("tools","assistant")
-workflow.add_edge("ask_human", "assistant")
+workflow.add_edge("load_user_info", "fold_search_criteria")
+workflow.add_edge("ask_human", "load_user_info")
 
 # Finally, we compile it!
 # This compiles it into a LangChain Runnable,
 # meaning you can use it as you would any other runnable
-conn = sqlite3.connect(":memory:")
-memory = MemorySaver()
+memory = sqlite_checkpointer()
 graph = workflow.compile(checkpointer=memory, interrupt_before=["ask_human"])
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, AsyncIterator, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.serde.base import SerializerProtocol
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_DB_PATH = os.environ.get("CHECKPOINT_DB_PATH", "db/checkpoints.sqlite")
+CHECKPOINT_KEEP_LAST = int(os.environ.get("CHECKPOINT_KEEP_LAST", "10"))
+CHECKPOINT_THREAD_TTL_SECONDS = int(os.environ.get("CHECKPOINT_THREAD_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+CHECKPOINT_VACUUM_INTERVAL_SECONDS = int(os.environ.get("CHECKPOINT_VACUUM_INTERVAL_SECONDS", "3600"))
+
+# payloads smaller than this don't shrink enough to be worth compressing
+COMPRESS_MIN_BYTES = 512
+COMPRESSED_PREFIX = "zlib:"
+
+
+class CompactSerializer(SerializerProtocol):
+    """the usual msgpack serializer, with zlib over anything large like the message history"""
+
+    def __init__(self, serde: Optional[SerializerProtocol] = None, level: int = 6):
+        self.serde = serde or JsonPlusSerializer()
+        self.level = level
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.serde.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.serde.loads(data)
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if len(data) < COMPRESS_MIN_BYTES:
+            return type_, data
+        return COMPRESSED_PREFIX + type_, zlib.compress(data, self.level)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_.startswith(COMPRESSED_PREFIX):
+            return self.serde.loads_typed((type_[len(COMPRESSED_PREFIX):], zlib.decompress(payload)))
+        return self.serde.loads_typed(data)
+
+
+class PruningSqliteSaver(SqliteSaver):
+    """
+    a file backed checkpointer that only keeps the last few checkpoints of each thread, and forgets threads
+    nobody has touched for thread_ttl seconds. the async api runs the sqlite calls on worker threads
+    """
+
+    def __init__(self, conn: sqlite3.Connection, keep_last: int = CHECKPOINT_KEEP_LAST,
+                 thread_ttl: int = CHECKPOINT_THREAD_TTL_SECONDS, serde: Optional[SerializerProtocol] = None):
+        super().__init__(conn, serde=serde or CompactSerializer())
+        # the parent of the latest checkpoint is needed to resume an interrupted run
+        self.keep_last = max(keep_last, 2)
+        self.thread_ttl = thread_ttl
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        # only takes effect on a new database, before any tables exist
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        super().setup()
+        self.conn.executescript(
+            """
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS thread_activity (
+                thread_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS thread_activity_updated_at ON thread_activity (updated_at);
+            """
+        )
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        saved = super().put(config, checkpoint, metadata, new_versions)
+        self.prune(str(config["configurable"]["thread_id"]), config["configurable"]["checkpoint_ns"])
+        return saved
+
+    def prune(self, thread_id: str, checkpoint_ns: str):
+        """drop all but the newest keep_last checkpoints of a thread, and the writes that belong to them"""
+        kept = ("SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT ?")
+        args = (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.keep_last)
+        with self.cursor() as cur:
+            cur.execute(f"DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})", args)
+            cur.execute(f"DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})", args)
+            cur.execute("INSERT OR REPLACE INTO thread_activity (thread_id, updated_at) VALUES (?, ?)",
+                        (thread_id, time.time()))
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM thread_activity WHERE thread_id = ?", (str(thread_id),))
+
+    def expire_idle_threads(self) -> int:
+        with self.cursor() as cur:
+            cur.execute("SELECT thread_id FROM thread_activity WHERE updated_at < ?", (time.time() - self.thread_ttl,))
+            expired = [row[0] for row in cur.fetchall()]
+        for thread_id in expired:
+            self.delete_thread(thread_id)
+        return len(expired)
+
+    def vacuum(self):
+        """expire idle threads, then hand freed pages back to the os and truncate the wal"""
+        expired = self.expire_idle_threads()
+        with self.cursor() as cur:
+            cur.execute("PRAGMA incremental_vacuum")
+            cur.fetchall()
+            cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            cur.fetchall()
+        log.info(f"checkpoint vacuum expired {expired} idle threads")
+
+    def start_vacuuming(self, interval: int = CHECKPOINT_VACUUM_INTERVAL_SECONDS) -> threading.Thread:
+        def run():
+            while True:
+                try:
+                    self.vacuum()
+                except sqlite3.Error as e:
+                    log.warning(f"checkpoint vacuum failed: {e}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="checkpoint-vacuum", daemon=True)
+        thread.start()
+        return thread
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoints = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def sqlite_checkpointer(path: str = CHECKPOINT_DB_PATH, vacuum: bool = True) -> PruningSqliteSaver:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    saver = PruningSqliteSaver(sqlite3.connect(path, check_same_thread=False))
+    if vacuum:
+        saver.start_vacuuming()
+    return saver
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import re
+from typing import Optional, Sequence
+
+from langchain.chat_models import init_chat_model
+from langchain_core.messages import BaseMessage, HumanMessage, RemoveMessage, ToolMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+
+from tina.retrievers.tokens import count_tokens, truncate_to_tokens
+from tina.retrievers.utils import message_text
+
+log = logging.getLogger(__name__)
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "6000"))
+HISTORY_KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", "4"))
+HISTORY_SUMMARY_TOKENS = int(os.environ.get("HISTORY_SUMMARY_TOKENS", "400"))
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+
+# tool results at or below this size are kept as they are, a reference wouldn't be much shorter
+REFERENCE_MIN_TOKENS = 60
+REFERENCE_PREFIX = "[earlier "
+URLS = re.compile(r"https?://[^\s\"',\]]+")
+
+llm = init_chat_model(HISTORY_SUMMARY_MODEL, model_provider="openai")
+
+summary_chain = PromptTemplate(
+    template="""You keep a running summary of a chat between Tina, a sales assistant for Turners Automotive, and a customer looking for a vehicle.
+    Update the summary with the new messages. Keep what the customer wants (budget, type of vehicle, features, locations),
+    the vehicles discussed with their source urls, and anything the customer asked Tina to do. Use at most {words} words.
+
+    Summary so far:
+    {summary}
+
+    New messages:
+    {messages}
+    """,
+    input_variables=["summary", "messages", "words"],
+) | llm | StrOutputParser()
+
+
+def message_tokens(message: BaseMessage) -> int:
+    tokens = count_tokens(message_text(message))
+    for tool_call in getattr(message, "tool_calls", None) or []:
+        tokens += count_tokens(json.dumps(tool_call["args"]))
+    return tokens
+
+
+def split_turns(messages: Sequence[BaseMessage]) -> list[list[BaseMessage]]:
+    """group messages into turns each starting at a human message, so a tool call never ends up apart from its result"""
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def tool_reference(message: ToolMessage) -> str:
+    urls = list(dict.fromkeys(URLS.findall(message_text(message))))[:5]
+    reference = f"{REFERENCE_PREFIX}{message.name or 'tool'} result, {message_tokens(message)} tokens, no longer shown]"
+    return f"{reference} sources: {', '.join(urls)}" if urls else reference
+
+
+def render(messages: Sequence[BaseMessage]) -> str:
+    lines = []
+    for message in messages:
+        if isinstance(message, ToolMessage):
+            lines.append(f"tool {message.name}: {message_text(message)}")
+        elif message_text(message):
+            lines.append(f"{message.type}: {message_text(message)}")
+    return "\n".join(lines)
+
+
+class HistoryWindow:
+    """
+    keeps the last keep_turns turns as they are. tool results older than that are swapped for short references,
+    and once the history is over the token budget the older turns are folded into a rolling summary and removed
+    """
+
+    def __init__(self, budget: int = HISTORY_TOKEN_BUDGET, keep_turns: int = HISTORY_KEEP_TURNS,
+                 summary_tokens: int = HISTORY_SUMMARY_TOKENS):
+        self.budget = budget
+        self.keep_turns = max(keep_turns, 1)
+        self.summary_tokens = summary_tokens
+
+    def plan(self, messages: Sequence[BaseMessage], summary: Optional[str]) -> tuple[list[BaseMessage], list[BaseMessage], int]:
+        """the old messages with references in place of tool results, the updates to make that so, and the total tokens"""
+        turns = split_turns(messages)
+        old = [m for turn in turns[:-self.keep_turns] for m in turn]
+        recent = [m for turn in turns[-self.keep_turns:] for m in turn]
+
+        compacted, updates = [], []
+        for message in old:
+            if (isinstance(message, ToolMessage) and not message_text(message).startswith(REFERENCE_PREFIX)
+                    and message_tokens(message) > REFERENCE_MIN_TOKENS):
+                message = message.model_copy(update={"content": tool_reference(message)})
+                updates.append(message)
+            compacted.append(message)
+
+        total = count_tokens(summary or "") + sum(message_tokens(m) for m in compacted + recent)
+        return compacted, updates, total
+
+    def summary_input(self, summary: Optional[str], old: list[BaseMessage]) -> dict:
+        return {"summary": summary or "nothing yet", "messages": render(old), "words": int(self.summary_tokens * 0.75)}
+
+    def result(self, old: list[BaseMessage], updates: list[BaseMessage], summary: Optional[str]) -> dict:
+        if summary is None:
+            return {"messages": updates} if updates else {}
+        log.info(f"folded {len(old)} messages into the conversation summary")
+        return {
+            "messages": [RemoveMessage(id=m.id) for m in old],
+            "summary": truncate_to_tokens(summary.strip(), self.summary_tokens),
+        }
+
+    def __call__(self, messages: Sequence[BaseMessage], summary: Optional[str] = None) -> dict:
+        old, updates, total = self.plan(messages, summary)
+        if total <= self.budget or not old:
+            return self.result(old, updates, None)
+        return self.result(old, updates, summary_chain.invoke(self.summary_input(summary, old)))
+
+    async def acall(self, messages: Sequence[BaseMessage], summary: Optional[str] = None) -> dict:
+        old, updates, total = self.plan(messages, summary)
+        if total <= self.budget or not old:
+            return self.result(old, updates, None)
+        return self.result(old, updates, await summary_chain.ainvoke(self.summary_input(summary, old)))
+
+
+history_window = HistoryWindow()
@@ -5,3 +5,4 @@ from pydantic import BaseModel, Field
 class UserProfile(BaseModel):
     user_id: str = Field("Unique identifier for this user")
     name: str = Field("The name the the user would like to be called")
+    preferred_branches: List[str] = Field(default_factory=list, description="the turners branches the user likes to shop at")
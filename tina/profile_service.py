@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from tinydb import Query, TinyDB
+
+from tina.model.user_profile import UserProfile
+
+log = logging.getLogger(__name__)
+
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "1024"))
+
+
+class ProfileService:
+    """
+    user profiles from db/user.json, kept in an lru cache. changes land in the cache straight away and are
+    written through to the file on a single background worker, so writes for one user stay in order
+    """
+
+    def __init__(self, path: str = "db/user.json", cache_size: int = PROFILE_CACHE_SIZE):
+        self.db = TinyDB(path)
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, UserProfile] = OrderedDict()
+        self._lock = threading.RLock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile-writer")
+        self._pending: Optional[Future] = None
+
+    def _remember(self, profile: UserProfile):
+        self._cache[profile.user_id] = profile
+        self._cache.move_to_end(profile.user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _cached(self, user_id: str) -> Optional[UserProfile]:
+        with self._lock:
+            profile = self._cache.get(user_id)
+            if profile is not None:
+                self._cache.move_to_end(user_id)
+            return profile
+
+    def _load(self, user_id: str) -> Optional[UserProfile]:
+        # profiles are stored under "id", early ones were written with "user_id"
+        q = Query()
+        with self._lock:
+            records = self.db.search((q.id == user_id) | (q.user_id == user_id))
+        if not records:
+            return None
+        record = {k: v for k, v in records[0].items() if k != "id"}
+        return UserProfile(**{**record, "user_id": user_id})
+
+    def _write(self, profile: UserProfile):
+        record = {"id": profile.user_id, **profile.model_dump(exclude={"user_id"})}
+        q = Query()
+        with self._lock:
+            self.db.remove(q.user_id == profile.user_id)
+            self.db.upsert(record, q.id == profile.user_id)
+
+    def _write_through(self, profile: UserProfile):
+        def write():
+            try:
+                self._write(profile)
+            except Exception as e:
+                log.error(f"unable to save profile for {profile.user_id}: {e}")
+        self._pending = self._writer.submit(write)
+
+    def get(self, user_id: str) -> UserProfile:
+        profile = self._cached(user_id)
+        if profile is not None:
+            return profile
+
+        profile = self._load(user_id)
+        with self._lock:
+            if profile is None:
+                profile = UserProfile(user_id=user_id, name="")
+                self._write_through(profile)
+            self._remember(profile)
+        return profile
+
+    async def aget(self, user_id: str) -> UserProfile:
+        profile = self._cached(user_id)
+        if profile is not None:
+            return profile
+        return await asyncio.to_thread(self.get, user_id)
+
+    def update(self, user_id: str, **changes) -> UserProfile:
+        profile = self.get(user_id).model_copy(update=changes)
+        with self._lock:
+            self._remember(profile)
+            self._write_through(profile)
+        return profile
+
+    def flush(self):
+        """wait for the writes queued so far"""
+        pending = self._pending
+        if pending is not None:
+            pending.result()
+
+
+profile_service = ProfileService()
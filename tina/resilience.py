@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+
+import httpx
+import openai
+from langchain_core.runnables import Runnable, RunnableConfig
+
+log = logging.getLogger(__name__)
+
+ASSISTANT_TIMEOUT_SECONDS = float(os.environ.get("ASSISTANT_TIMEOUT_SECONDS", "30"))
+ASSISTANT_MAX_ATTEMPTS = int(os.environ.get("ASSISTANT_MAX_ATTEMPTS", "3"))
+ASSISTANT_BACKOFF_SECONDS = float(os.environ.get("ASSISTANT_BACKOFF_SECONDS", "0.5"))
+ASSISTANT_BACKOFF_MAX_SECONDS = float(os.environ.get("ASSISTANT_BACKOFF_MAX_SECONDS", "4"))
+# "on" sends a second request when the first is slower than the hedge percentile of recent calls
+ASSISTANT_HEDGE = os.environ.get("ASSISTANT_HEDGE", "off") == "on"
+ASSISTANT_HEDGE_PERCENTILE = float(os.environ.get("ASSISTANT_HEDGE_PERCENTILE", "0.95"))
+ASSISTANT_HEDGE_MIN_SAMPLES = int(os.environ.get("ASSISTANT_HEDGE_MIN_SAMPLES", "20"))
+# threads the sync api runs attempts on, shared by every conversation, a hedged call holds two
+ASSISTANT_WORKERS = int(os.environ.get("ASSISTANT_WORKERS", "32"))
+
+
+class EmptyResponse(Exception):
+    pass
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    timeouts, empty responses, rate limits, server errors and dropped connections can go the other way on a retry.
+    anything else, a bad request, auth, a missing model or too long a context, fails the same way every time
+    """
+    if isinstance(e, (TimeoutError, EmptyResponse, ConnectionError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(e, "status_code", None) or getattr(e, "status", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+class LatencyRecorder:
+    """latency of recent calls, for picking the hedge delay and for tuning the tail"""
+
+    def __init__(self, window: int = 500):
+        self.samples = deque(maxlen=window)
+        self.outcomes = {}
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, outcome: str, attempt: int, hedged: bool):
+        with self._lock:
+            if outcome == "ok":
+                self.samples.append(seconds)
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        log.info(f"assistant attempt {attempt}{' (hedge)' if hedged else ''}: {outcome} in {seconds:.2f}s")
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, outcomes = len(self.samples), dict(self.outcomes)
+        return {"count": count, "p50": self.percentile(0.5), "p95": self.percentile(0.95),
+                "p99": self.percentile(0.99), "outcomes": outcomes}
+
+
+assistant_latency = LatencyRecorder()
+
+
+class ResilientCall:
+    """
+    calls a runnable with a timeout per attempt and a capped number of attempts, backing off with full jitter
+    between them. an empty response counts as a failed attempt, and the next one gets the input from on_empty,
+    errors that would only fail again are raised straight away. with hedging on, a second request is raced
+    against the first once it runs past the recent p95.
+
+    a sync attempt that times out can't be interrupted and keeps its worker until the request returns, so the
+    runnable's client should have a request timeout no longer than the attempt timeout or repeated timeouts
+    can fill the pool (ASSISTANT_WORKERS threads) and hold up later calls
+    """
+
+    def __init__(self, runnable: Runnable, is_empty: Callable[[Any], bool], on_empty: Callable[[Any], Any],
+                 timeout: float = ASSISTANT_TIMEOUT_SECONDS, max_attempts: int = ASSISTANT_MAX_ATTEMPTS,
+                 backoff: float = ASSISTANT_BACKOFF_SECONDS, backoff_max: float = ASSISTANT_BACKOFF_MAX_SECONDS,
+                 hedge: bool = ASSISTANT_HEDGE, recorder: LatencyRecorder = assistant_latency,
+                 workers: int = ASSISTANT_WORKERS):
+        self.runnable = runnable
+        self.is_empty = is_empty
+        self.on_empty = on_empty
+        self.timeout = timeout
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.recorder = recorder
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="assistant")
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self.recorder.samples) < ASSISTANT_HEDGE_MIN_SAMPLES:
+            return None
+        delay = self.recorder.percentile(ASSISTANT_HEDGE_PERCENTILE)
+        return delay if delay < self.timeout else None
+
+    def sleep_for(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def timed(self, call: Callable[[], Any], attempt: int, hedged: bool) -> Any:
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception as e:
+            self.recorder.record(time.perf_counter() - start, type(e).__name__, attempt, hedged)
+            raise
+        self.recorder.record(time.perf_counter() - start, "empty" if self.is_empty(result) else "ok", attempt, hedged)
+        return result
+
+    async def atimed(self, input: Any, config: Optional[RunnableConfig], attempt: int, hedged: bool) -> Any:
+        start = time.perf_counter()
+        try:
+            result = await self.runnable.ainvoke(input, config)
+        except asyncio.CancelledError:
+            self.recorder.record(time.perf_counter() - start, "cancelled", attempt, hedged)
+            raise
+        except Exception as e:
+            self.recorder.record(time.perf_counter() - start, type(e).__name__, attempt, hedged)
+            raise
+        self.recorder.record(time.perf_counter() - start, "empty" if self.is_empty(result) else "ok", attempt, hedged)
+        return result
+
+    def attempt(self, input: Any, config: Optional[RunnableConfig], attempt: int) -> Any:
+        futures = [self.executor.submit(self.timed, lambda: self.runnable.invoke(input, config), attempt, False)]
+        deadline = time.monotonic() + self.timeout
+
+        delay = self.hedge_delay()
+        if delay is not None:
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                futures.append(self.executor.submit(self.timed, lambda: self.runnable.invoke(input, config), attempt, True))
+
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                # the threads can't be interrupted, whatever they return is dropped
+                raise TimeoutError(f"assistant did not respond within {self.timeout}s")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        raise futures[0].exception()
+
+    async def aattempt(self, input: Any, config: Optional[RunnableConfig], attempt: int) -> Any:
+        tasks = [asyncio.ensure_future(self.atimed(input, config, attempt, False))]
+        try:
+            async with asyncio.timeout(self.timeout):
+                delay = self.hedge_delay()
+                if delay is not None:
+                    done, _ = await asyncio.wait(tasks, timeout=delay)
+                    if not done:
+                        tasks.append(asyncio.ensure_future(self.atimed(input, config, attempt, True)))
+
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            return task.result()
+                return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None) -> Any:
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.sleep_for(attempt))
+            try:
+                result = self.attempt(input, config, attempt)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                error = e
+                continue
+            if not self.is_empty(result):
+                return result
+            error = EmptyResponse(f"empty response on attempt {attempt}")
+            input = self.on_empty(input)
+        raise error
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None) -> Any:
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                await asyncio.sleep(self.sleep_for(attempt))
+            try:
+                result = await self.aattempt(input, config, attempt)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                error = e
+                continue
+            if not self.is_empty(result):
+                return result
+            error = EmptyResponse(f"empty response on attempt {attempt}")
+            input = self.on_empty(input)
+        raise error
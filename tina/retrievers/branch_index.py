@@ -0,0 +1,51 @@
+import logging
+from typing import Iterable, Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class BranchIndex:
+    """branch coordinates held as radians in numpy arrays, so every proximity query is one vectorised haversine"""
+
+    def __init__(self, branches: Iterable):
+        branches = list(branches)
+        located = [b for b in branches if b.lat is not None and b.lng is not None]
+        for branch in branches:
+            if branch not in located:
+                log.warning(f"no coordinates for branch {branch.name}, leaving it out of proximity searches")
+
+        self.names = np.array([b.name for b in located], dtype=object)
+        self.lat = np.radians(np.array([b.lat for b in located], dtype=np.float64))
+        self.lng = np.radians(np.array([b.lng for b in located], dtype=np.float64))
+        self.cos_lat = np.cos(self.lat)
+
+    def __len__(self):
+        return len(self.names)
+
+    def distances(self, lat: float, lng: float) -> np.ndarray:
+        """km from the point to every branch"""
+        lat, lng = np.radians(lat), np.radians(lng)
+        a = np.sin((self.lat - lat) / 2) ** 2 + np.cos(lat) * self.cos_lat * np.sin((self.lng - lng) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    def _sorted(self, distances: np.ndarray, indices: np.ndarray) -> list[tuple[str, float]]:
+        indices = indices[np.argsort(distances[indices], kind="stable")]
+        return [(self.names[i], float(distances[i])) for i in indices]
+
+    def within(self, lat: float, lng: float, radius_km: float) -> list[tuple[str, float]]:
+        distances = self.distances(lat, lng)
+        return self._sorted(distances, np.flatnonzero(distances <= radius_km))
+
+    def nearest(self, lat: float, lng: float, k: int, radius_km: Optional[float] = None) -> list[tuple[str, float]]:
+        distances = self.distances(lat, lng)
+        k = min(max(k, 0), len(distances))
+        if k == 0:
+            return []
+        indices = np.argpartition(distances, k - 1)[:k]
+        if radius_km is not None:
+            indices = indices[distances[indices] <= radius_km]
+        return self._sorted(distances, indices)
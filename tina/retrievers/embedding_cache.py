@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+log = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "db/embeddings.sqlite")
+EMBEDDING_CACHE_LRU_SIZE = int(os.environ.get("EMBEDDING_CACHE_LRU_SIZE", "2048"))
+
+
+def normalise_text(text: str, casefold: bool = False) -> str:
+    text = " ".join(text.split())
+    return text.casefold() if casefold else text
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    wraps an embedding model with an in process LRU and an on disk sqlite tier holding float16 vectors,
+    keyed by (model, dimensions, normalised text). queries are case folded as well as whitespace normalised
+    so "Fun car" and "fun car " share an entry.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, dimensions: Optional[int],
+                 path: Optional[str] = EMBEDDING_CACHE_PATH, lru_size: int = EMBEDDING_CACHE_LRU_SIZE):
+        self.embeddings = embeddings
+        self.model = model
+        self.dimensions = dimensions
+        self.lru_size = lru_size
+        self.counters = Counter()
+        self._lru: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._conn.commit()
+
+    def _key(self, text: str, kind: str) -> str:
+        normalised = normalise_text(text, casefold=kind == "query")
+        return hashlib.sha256(f"{self.model}|{self.dimensions}|{kind}|{normalised}".encode()).hexdigest()
+
+    def _remember(self, key: str, vector: List[float]):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _lookup(self, keys: List[str]) -> dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+                    self.counters["memory_hits"] += 1
+
+            missing = [key for key in keys if key not in found]
+            if missing and self._conn is not None:
+                placeholders = ",".join("?" * len(missing))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", missing).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float16).astype(np.float32).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+                    self.counters["disk_hits"] += 1
+
+            self.counters["misses"] += len(set(keys) - set(found))
+        return found
+
+    def _store(self, entries: dict[str, List[float]]):
+        with self._lock:
+            for key, vector in entries.items():
+                self._remember(key, vector)
+            if self._conn is not None:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float16).tobytes()) for key, vector in entries.items()])
+                self._conn.commit()
+
+    def _embed(self, texts: List[str], kind: str, embed) -> List[List[float]]:
+        keys = [self._key(text, kind) for text in texts]
+        found = self._lookup(keys)
+
+        # embed each distinct missing text once, even if it appears several times in the batch
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = embed(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def _aembed(self, texts: List[str], kind: str, aembed) -> List[List[float]]:
+        keys = [self._key(text, kind) for text in texts]
+        found = self._lookup(keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = await aembed(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document", self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], "query", lambda t: [self.embeddings.embed_query(t[0])])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed(texts, "document", self.embeddings.aembed_documents)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        async def aembed(t):
+            return [await self.embeddings.aembed_query(t[0])]
+        return (await self._aembed([text], "query", aembed))[0]
+
+    def stats(self) -> dict:
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        lookups = hits + self.counters["misses"]
+        return {**self.counters, "hit_rate": hits / lookups if lookups else 0.0}
+
+
+@lru_cache(maxsize=None)
+def cached_embeddings(model: str = "text-embedding-3-large", dimensions: int = 2048) -> CachedEmbeddings:
+    """process wide cached OpenAI embeddings, shared by the search tools and the scraper"""
+    return CachedEmbeddings(OpenAIEmbeddings(model=model, dimensions=dimensions), model, dimensions)
@@ -0,0 +1,182 @@
+import json
+import logging
+import math
+import os
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+
+from tina.retrievers.listing_repository import ListingRepository, listing_repository
+
+log = logging.getLogger(__name__)
+
+CATEGORICAL_FACETS = ("vehicle_type", "make", "model", "location", "fuel")
+NUMERIC_FACETS = ("year", "odometer", "price")
+
+
+def _nice_step(lower: float, upper: float, target: int) -> float:
+    raw = max(upper - lower, 1) / target
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for multiple in (1, 2, 2.5, 5, 10):
+        if raw <= multiple * magnitude:
+            return multiple * magnitude
+    return 10 * magnitude
+
+
+def buckets(lower: float, upper: float, target: int = 10, min_step: float = 1) -> list[float]:
+    """round numbered bucket boundaries covering [lower, upper]"""
+    step = max(_nice_step(lower, upper, target), min_step)
+    start = math.floor(lower / step) * step
+    stop = math.ceil(upper / step) * step
+    count = int(round((stop - start) / step))
+    return [start + i * step for i in range(count + 1)]
+
+
+def _year_label(value: float) -> str:
+    return str(int(value))
+
+
+def _kms_label(value: float) -> str:
+    return f"{int(value):,} kms"
+
+
+def _price_label(value: float) -> str:
+    return f"${value / 1000:g}k" if value >= 1000 else f"${value:g}"
+
+
+def _bump(counter: Counter, key, delta: int):
+    counter[key] += delta
+    # drop anything that has fallen to zero so stale options disappear from the UI
+    if counter[key] <= 0:
+        del counter[key]
+
+
+class FacetCatalogue:
+    """facet counts over the listing store, maintained incrementally as listings come and go"""
+
+    def __init__(self):
+        self.version = 0
+        self.inventory_version = None
+        self.counts = {facet: Counter() for facet in CATEGORICAL_FACETS}
+        self.values = {facet: Counter() for facet in NUMERIC_FACETS}
+        self.vehicle_type_to_makes = defaultdict(Counter)
+        self.make_to_models = defaultdict(Counter)
+        self._serialized = None
+
+    @classmethod
+    def from_listings(cls, listings: Iterable[dict]) -> "FacetCatalogue":
+        catalogue = cls()
+        for listing in listings:
+            catalogue.add(listing)
+        return catalogue
+
+    def add(self, listing: dict):
+        self._update(listing, 1)
+
+    def remove(self, listing: dict):
+        self._update(listing, -1)
+
+    def _update(self, listing: dict, delta: int):
+        metadata = listing.get("metadata")
+        if not metadata:
+            return
+
+        for facet in CATEGORICAL_FACETS:
+            if metadata.get(facet) is not None:
+                _bump(self.counts[facet], metadata[facet], delta)
+        for facet in NUMERIC_FACETS:
+            if isinstance(metadata.get(facet), (int, float)):
+                _bump(self.values[facet], metadata[facet], delta)
+        if metadata.get("vehicle_type") and metadata.get("make"):
+            _bump(self.vehicle_type_to_makes[metadata["vehicle_type"]], metadata["make"], delta)
+        if metadata.get("make") and metadata.get("model"):
+            _bump(self.make_to_models[metadata["make"]], metadata["model"], delta)
+
+        self.version += 1
+        self._serialized = None
+
+    def _options(self, facet: str, label, any_label: str, min_step: float, target: int = 10) -> list[str]:
+        values = self.values[facet]
+        if not values:
+            return [any_label]
+        boundaries = buckets(min(values), max(values), target=target, min_step=min_step)
+        return [any_label] + [label(b) for b in boundaries if b > 0]
+
+    def to_dict(self) -> dict:
+        return {
+            "vehicle_type_to_makes": {k: sorted(v) for k, v in self.vehicle_type_to_makes.items() if v},
+            "make_to_models": {k: sorted(v) for k, v in self.make_to_models.items() if v},
+            "vehicle_types": sorted(self.counts["vehicle_type"]),
+            "makes": sorted(self.counts["make"]),
+            "models": sorted(self.counts["model"]),
+            "years": self._options("year", _year_label, "Any Year", 1, target=20),
+            "kms": self._options("odometer", _kms_label, "Any Kms", 1000),
+            "prices": self._options("price", _price_label, "Any Price", 500),
+            "counts": {facet: dict(counter.most_common()) for facet, counter in self.counts.items()},
+        }
+
+    def to_json(self) -> str:
+        if self._serialized is None:
+            self._serialized = json.dumps(self.to_dict())
+        return self._serialized
+
+    def save(self, path: str):
+        state = {
+            "version": self.version,
+            "inventory_version": self.inventory_version,
+            "counts": {facet: dict(counter) for facet, counter in self.counts.items()},
+            "values": {facet: list(counter.items()) for facet, counter in self.values.items()},
+            "vehicle_type_to_makes": {k: dict(v) for k, v in self.vehicle_type_to_makes.items()},
+            "make_to_models": {k: dict(v) for k, v in self.make_to_models.items()},
+        }
+        with open(path, "w") as f:
+            json.dump(state, f)
+
+    @classmethod
+    def load(cls, path: str) -> "FacetCatalogue":
+        with open(path) as f:
+            state = json.load(f)
+
+        catalogue = cls()
+        catalogue.version = state["version"]
+        catalogue.inventory_version = state.get("inventory_version")
+        for facet, counts in state["counts"].items():
+            catalogue.counts[facet] = Counter(counts)
+        for facet, items in state["values"].items():
+            catalogue.values[facet] = Counter(dict((value, count) for value, count in items))
+        for k, v in state["vehicle_type_to_makes"].items():
+            catalogue.vehicle_type_to_makes[k] = Counter(v)
+        for k, v in state["make_to_models"].items():
+            catalogue.make_to_models[k] = Counter(v)
+        return catalogue
+
+
+def inventory_version(repository: ListingRepository) -> Optional[list]:
+    generation = repository.generation
+    return list(generation) if generation is not None else None
+
+
+_cache: dict[str, tuple[tuple, FacetCatalogue]] = {}
+
+
+def load_facet_catalogue(path: str = "db/facets.json", repository: ListingRepository = listing_repository) -> FacetCatalogue:
+    """load the persisted catalogue, rebuilding it only when the listing store has moved on without it"""
+    version = (inventory_version(repository), os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    catalogue = FacetCatalogue.load(path) if os.path.exists(path) else None
+    if catalogue is None or catalogue.inventory_version != inventory_version(repository):
+        log.info("rebuilding facet catalogue from listing store")
+        catalogue = FacetCatalogue.from_listings(repository.all())
+        save_facet_catalogue(catalogue, path, repository)
+
+    version = (inventory_version(repository), os.stat(path).st_mtime_ns)
+    _cache[path] = (version, catalogue)
+    return catalogue
+
+
+def save_facet_catalogue(catalogue: FacetCatalogue, path: str = "db/facets.json",
+                         repository: ListingRepository = listing_repository):
+    catalogue.inventory_version = inventory_version(repository)
+    catalogue.save(path)
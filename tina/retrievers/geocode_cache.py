@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+# "google" resolves misses with the places api, "fixture" only ever serves coordinates from GEOCODE_FIXTURE_PATH
+GEOCODE_MODE = os.environ.get("GEOCODE_MODE", "google")
+GEOCODE_CACHE_PATH = os.environ.get("GEOCODE_CACHE_PATH", "db/geocode.json")
+GEOCODE_FIXTURE_PATH = os.environ.get("GEOCODE_FIXTURE_PATH", "db/branch_coordinates.json")
+GEOCODE_TIMEOUT_SECONDS = float(os.environ.get("GEOCODE_TIMEOUT_SECONDS", "5"))
+GEOCODE_CONCURRENCY = int(os.environ.get("GEOCODE_CONCURRENCY", "8"))
+
+PLACE_DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
+
+
+def load_coordinates(path: str) -> dict[str, tuple[float, float]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {place_id: tuple(lat_lng) for place_id, lat_lng in json.load(f).items()}
+
+
+class GeocodeCache:
+    """lat/lng by google place id, kept in a json file so every worker process shares the lookups"""
+
+    def __init__(self, path: str = GEOCODE_CACHE_PATH, mode: str = GEOCODE_MODE,
+                 fixture_path: str = GEOCODE_FIXTURE_PATH):
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self.coordinates = load_coordinates(fixture_path if mode == "fixture" else path)
+        self._session = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=GEOCODE_CONCURRENCY))
+        return self._session
+
+    def get(self, place_id: str) -> Optional[tuple[float, float]]:
+        return self.coordinates.get(place_id)
+
+    def fetch(self, place_id: str) -> Optional[tuple[float, float]]:
+        """Get latitude and longitude for a place ID using Google Places API"""
+        params = {"place_id": place_id, "fields": "geometry", "key": os.environ["GOOGLE_API_KEY"]}
+        try:
+            response = self.session.get(PLACE_DETAILS_URL, params=params, timeout=GEOCODE_TIMEOUT_SECONDS)
+        except requests.RequestException as e:
+            log.warning(f"unable to geocode {place_id}: {e}")
+            return None
+
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("result") and result["result"].get("geometry"):
+                location = result["result"]["geometry"]["location"]
+                return location["lat"], location["lng"]
+        return None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock:
+            data = {place_id: list(lat_lng) for place_id, lat_lng in self.coordinates.items()}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def resolve(self, place_ids: Iterable[str]) -> dict[str, tuple[float, float]]:
+        """coordinates for every place id that can be found, looking up any misses concurrently"""
+        place_ids = list(dict.fromkeys(place_ids))
+        missing = [p for p in place_ids if p not in self.coordinates]
+        if missing and self.mode != "fixture":
+            log.info(f"geocoding {len(missing)} places")
+            with ThreadPoolExecutor(max_workers=GEOCODE_CONCURRENCY) as executor:
+                found = dict(zip(missing, executor.map(self.fetch, missing)))
+            with self._lock:
+                self.coordinates.update({p: lat_lng for p, lat_lng in found.items() if lat_lng is not None})
+            self.save()
+        return {p: self.coordinates[p] for p in place_ids if p in self.coordinates}
+
+
+geocode_cache = GeocodeCache()
+
+
+def prefetch_locations(locations: Iterable) -> list:
+    """fill in lat/lng on anything with a place_id and no coordinates, in one concurrent batch"""
+    locations = list(locations)
+    missing = [location for location in locations if location.lat is None or location.lng is None]
+    if missing:
+        found = geocode_cache.resolve(location.place_id for location in missing)
+        for location in missing:
+            if location.place_id in found:
+                location.lat, location.lng = found[location.place_id]
+    return locations
@@ -0,0 +1,102 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Iterable, Optional
+
+import numpy as np
+
+from tina.retrievers.listing_repository import ListingRepository, listing_repository
+
+log = logging.getLogger(__name__)
+
+ANY_OPTIONS = {"any year", "any kms", "any price", "any"}
+MULTIPLIERS = {"k": 1_000, "m": 1_000_000}
+
+
+@lru_cache(maxsize=256)
+def parse_option_bound(label: Optional[str]) -> Optional[float]:
+    """turn option labels such as '$5k', '30,000 kms' or '2015' into a numeric bound"""
+    if label is None:
+        return None
+    text = str(label).strip().lower()
+    if not text or text in ANY_OPTIONS:
+        return None
+
+    # a k or m is only a multiplier on its own, not the start of "kms" or "miles"
+    match = re.match(r"^\$?\s*(\d[\d,]*(?:\.\d+)?)(?:\s*([km])(?![a-z]))?", text)
+    if not match:
+        raise ValueError(f"unable to parse option value: {label}")
+    value = float(match.group(1).replace(",", ""))
+    return value * MULTIPLIERS.get(match.group(2), 1)
+
+
+class InventoryIndex:
+    categorical_fields = ("vehicle_type", "make", "model", "location", "fuel")
+    numeric_fields = ("year", "odometer", "price")
+
+    def __init__(self, listings: Iterable[dict]):
+        self.listings = [listing for listing in listings if listing.get("metadata")]
+        metadata = [listing["metadata"] for listing in self.listings]
+
+        # missing or unparseable values become NaN so they never satisfy a range filter
+        self.columns = {
+            field: np.array([_as_float(m.get(field)) for m in metadata], dtype=np.float64)
+            for field in self.numeric_fields
+        }
+
+        self.bitmaps = {}
+        for field in self.categorical_fields:
+            values = np.array([m.get(field) for m in metadata], dtype=object)
+            self.bitmaps[field] = {value: values == value for value in set(values) if value is not None}
+
+        log.info(f"built inventory index over {len(self.listings)} listings")
+
+    def __len__(self):
+        return len(self.listings)
+
+    def mask(self, equals: dict = None, ranges: dict = None) -> np.ndarray:
+        mask = np.ones(len(self.listings), dtype=bool)
+
+        for field, value in (equals or {}).items():
+            if value is None:
+                continue
+            bitmap = self.bitmaps[field].get(value)
+            if bitmap is None:
+                return np.zeros(len(self.listings), dtype=bool)
+            mask &= bitmap
+
+        for field, (lower, upper) in (ranges or {}).items():
+            column = self.columns[field]
+            if lower is not None:
+                mask &= column >= lower
+            if upper is not None:
+                mask &= column <= upper
+
+        return mask
+
+    def search(self, equals: dict = None, ranges: dict = None, limit: Optional[int] = None) -> list[dict]:
+        positions = np.flatnonzero(self.mask(equals, ranges))
+        if limit is not None:
+            positions = positions[:limit]
+        return [self.listings[i] for i in positions]
+
+
+def _as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+_cache: dict[int, tuple[tuple, InventoryIndex]] = {}
+
+
+def load_inventory_index(repository: ListingRepository = listing_repository) -> InventoryIndex:
+    """build the index once per generation of the listing store"""
+    generation = repository.generation
+    cached = _cache.get(id(repository))
+    if cached is None or cached[0] != generation:
+        index = InventoryIndex(repository.all())
+        _cache[id(repository)] = (generation, index)
+        return index
+    return cached[1]
@@ -0,0 +1,82 @@
+import os
+import re
+
+from tina.retrievers.tokens import count_tokens, truncate_to_tokens
+
+DIGEST_TOKEN_BUDGET = int(os.environ.get("LISTING_DIGEST_TOKEN_BUDGET", "250"))
+
+# share of what is left of the budget after the header line, in priority order
+SECTION_SHARES = (
+    ("Manufacturer", "manufacturer_details", 0.25),
+    ("Features", "feature_details", 0.4),
+    ("Condition", "condition_details", 0.25),
+    ("Good for", "possible_uses", 0.1),
+)
+
+LINKS = re.compile(r"\s*\((?:/|#|tel:|mailto:|https?:)[^)]*\)")
+BOILERPLATE = [
+    r"\*All On Road Costs included", r"BuyNow", r"Want Finance\?", r"Product Detail Core", r"Loading\.\.\.",
+    r"Find out more", r"Photo \d+ of \d+", r"\d+ page views", r"\d+ people have watchlisted this vehicle",
+    r"Start: [\w ]+", r"End: [\w ]+", r"View Similar Cars", r"View More from Catalogue", r"See More",
+    r"Book a Test Drive", r"Email Consultant", r"Further Information",
+    r"Buy with total confidence\..*?on this page\.",
+]
+BOILERPLATE_PATTERN = re.compile("|".join(BOILERPLATE))
+# blocks repeated on every listing page: sales contact, legal notices and tab headings
+BLOCKS_PATTERN = re.compile(r"Contact & Location.*?Further Information|Important Information.*?\(CIN\)"
+                            r"|Start: Tab Buttons.*?End: Tab Buttons|Additional Info Section")
+
+
+def digest_header(metadata: dict, source: str, image: str = None) -> str:
+    parts = [" ".join(str(metadata[k]) for k in ("year", "make", "model") if metadata.get(k))]
+    if metadata.get("price") is not None:
+        parts.append(f"${metadata['price']:,.0f}")
+    if metadata.get("odometer") is not None:
+        parts.append(f"{metadata['odometer']:,} km")
+    for key in ("fuel", "vehicle_type", "drive", "colour"):
+        if metadata.get(key):
+            parts.append(str(metadata[key]))
+    if metadata.get("seats"):
+        parts.append(f"{metadata['seats']} seats")
+    if metadata.get("location"):
+        parts.append(f"Turners {metadata['location']}")
+
+    header = f"{' | '.join(p for p in parts if p)}\nsource: {source}"
+    image = image or metadata.get("image")
+    if image:
+        header += f"\nimage: {image}"
+    return header
+
+
+def build_digest(sections: dict, metadata: dict, source: str, image: str = None,
+                 budget: int = DIGEST_TOKEN_BUDGET) -> str:
+    """a compact description of a listing for prompts, built from its sectioned content"""
+    header = digest_header(metadata, source, image)
+    available = budget - count_tokens(header)
+
+    lines = [header]
+    for label, key, share in SECTION_SHARES:
+        text = " ".join((sections.get(key) or "").split())
+        if text and available > 0:
+            lines.append(f"{label}: {truncate_to_tokens(text, int(available * share))}")
+    return "\n".join(lines)
+
+
+def clean_page_content(content: str) -> str:
+    content = LINKS.sub("", content)
+    if "Vehicle Details" in content:
+        content = content[content.index("Vehicle Details"):]
+    content = BLOCKS_PATTERN.sub(" ", content)
+    content = BOILERPLATE_PATTERN.sub(" ", content)
+    return " ".join(content.split())
+
+
+def digest_for(listing: dict, budget: int = DIGEST_TOKEN_BUDGET) -> str:
+    """the stored digest, or one made on the fly from the scraped page for listings ingested before digests existed"""
+    if listing.get("digest"):
+        return listing["digest"]
+
+    metadata = listing.get("metadata", {})
+    header = digest_header(metadata, listing["source"], listing.get("image"))
+    body = truncate_to_tokens(clean_page_content(listing.get("content", "")), budget - count_tokens(header))
+    return f"{header}\n{body}" if body else header
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+from typing import Iterable, Optional
+
+from tinydb import TinyDB, Query
+
+log = logging.getLogger(__name__)
+
+
+class ListingRepository:
+    """process wide view of the listing store, indexed by source url and reloaded only when the file changes"""
+
+    def __init__(self, path: str = "db/db.json"):
+        self.path = path
+        self.db = TinyDB(path)
+        self._lock = threading.RLock()
+        self._loaded_generation = None
+        self._listings: list[dict] = []
+        self._by_source: dict[str, dict] = {}
+
+    @property
+    def generation(self) -> Optional[tuple]:
+        if not os.path.exists(self.path):
+            return None
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        generation = self.generation
+        if generation == self._loaded_generation:
+            return
+        with self._lock:
+            if generation == self._loaded_generation:
+                return
+            self._listings = self.db.all()
+            self._by_source = {listing["source"]: listing for listing in self._listings}
+            self._loaded_generation = generation
+            log.info(f"loaded {len(self._listings)} listings from {self.path}")
+
+    def all(self) -> list[dict]:
+        """every listing in the store, shared between callers so treat it as read only"""
+        self._refresh()
+        return self._listings
+
+    def sources(self) -> set[str]:
+        self._refresh()
+        return set(self._by_source)
+
+    def __contains__(self, source: str) -> bool:
+        self._refresh()
+        return source in self._by_source
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self._listings)
+
+    def get(self, source: str) -> Optional[dict]:
+        self._refresh()
+        listing = self._by_source.get(source)
+        return dict(listing) if listing is not None else None
+
+    def get_many(self, sources: Iterable[str]) -> list[dict]:
+        """listings for the given sources in the order asked for, skipping any that are not in stock"""
+        self._refresh()
+        return [dict(self._by_source[s]) for s in sources if s in self._by_source]
+
+    def insert(self, listing: dict):
+        with self._lock:
+            self._refresh()
+            self.db.insert(listing)
+            self._listings.append(listing)
+            self._by_source[listing["source"]] = listing
+            self._loaded_generation = self.generation
+
+    def update_many(self, updates: dict[str, dict]):
+        """set fields on many listings, keyed by source, in a single write"""
+        with self._lock:
+            self._refresh()
+            self.db.update_multiple([(fields, Query().source == source) for source, fields in updates.items()])
+            for source, fields in updates.items():
+                if source in self._by_source:
+                    self._by_source[source].update(fields)
+            self._loaded_generation = self.generation
+
+    def remove(self, source: str):
+        with self._lock:
+            self._refresh()
+            self.db.remove(Query().source == source)
+            self._listings = [listing for listing in self._listings if listing["source"] != source]
+            self._by_source.pop(source, None)
+            self._loaded_generation = self.generation
+
+
+listing_repository = ListingRepository()
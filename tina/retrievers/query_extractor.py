@@ -1,10 +1,12 @@
 import logging
+import os
 
 from langchain.chat_models import init_chat_model
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate, FewShotPromptWithTemplates
 from langchain_core.utils.json import parse_json_markdown
 
+from tina.retrievers.rule_based_extractor import load_rule_based_extractor
 from tina.retrievers.templates import query_extraction_example_template, query_extraction_prefix, query_extraction_examples
 
 log = logging.getLogger(__name__)
@@ -12,6 +14,8 @@ log = logging.getLogger(__name__)
 
 class QueryExtractor:
     chat = init_chat_model("gpt-4o", model_provider="openai")
+    # rule based extractions at or above this confidence skip the LLM entirely
+    confidence_threshold = float(os.environ.get("RULE_EXTRACTOR_CONFIDENCE", "0.7"))
 
     metadata_field_info = {
         "content": "Vehicle Listings",
@@ -90,6 +94,22 @@ class QueryExtractor:
     )
 
     def extract_query(self, conversation: list):
+        extraction = load_rule_based_extractor().extract(conversation)
+        if extraction.confidence >= self.confidence_threshold:
+            log.info(f"rule based extraction ({extraction.confidence}): {extraction.result}")
+            return extraction.result
+        log.info(f"falling back to llm extraction ({extraction.confidence}): {extraction.reasons}")
+        return self.extract_query_with_llm(conversation)
+
+    async def aextract_query(self, conversation: list):
+        extraction = load_rule_based_extractor().extract(conversation)
+        if extraction.confidence >= self.confidence_threshold:
+            log.info(f"rule based extraction ({extraction.confidence}): {extraction.result}")
+            return extraction.result
+        log.info(f"falling back to llm extraction ({extraction.confidence}): {extraction.reasons}")
+        return await self.aextract_query_with_llm(conversation)
+
+    def extraction_chain(self):
         prefix = PromptTemplate(
             input_variables=["field_metadata"], template=query_extraction_prefix
         )
@@ -111,6 +131,12 @@ class QueryExtractor:
             example_separator="\n",
         )
 
-        chain = prompt | self.chat
-        output = chain.invoke({"field_metadata": self.metadata_field_info, "conversation": conversation})
+        return prompt | self.chat
+
+    def extract_query_with_llm(self, conversation: list):
+        output = self.extraction_chain().invoke({"field_metadata": self.metadata_field_info, "conversation": conversation})
+        return parse_json_markdown(output.content)
+
+    async def aextract_query_with_llm(self, conversation: list):
+        output = await self.extraction_chain().ainvoke({"field_metadata": self.metadata_field_info, "conversation": conversation})
         return parse_json_markdown(output.content)
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from tavily import AsyncTavilyClient, TavilyClient
+
+from tina.retrievers.rule_based_extractor import load_rule_based_extractor
+
+log = logging.getLogger(__name__)
+
+REVIEW_CACHE_PATH = os.environ.get("REVIEW_CACHE_PATH", "db/reviews.sqlite")
+REVIEW_CACHE_TTL = int(os.environ.get("REVIEW_CACHE_TTL", str(7 * 24 * 60 * 60)))
+REVIEW_FETCH_CONCURRENCY = int(os.environ.get("REVIEW_FETCH_CONCURRENCY", "4"))
+REVIEW_QUERY_PREFIX = "find feedback about this vehicle from other experts and consumers: "
+
+tavily_client = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+async_tavily_client = AsyncTavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+executor = ThreadPoolExecutor(max_workers=REVIEW_FETCH_CONCURRENCY)
+
+
+def review_key(make: Optional[str] = None, model: Optional[str] = None, year: Optional[int] = None,
+               variant: Optional[str] = None) -> str:
+    """normalised make/model/year/variant, so "Toyota  Corolla GX" and "toyota corolla gx" share reviews"""
+    parts = [str(p) for p in (make, model, year, variant) if p]
+    return " ".join(re.sub(r"[^\w.]+", " ", " ".join(parts).casefold()).split())
+
+
+def vehicle_review_keys(description: str, make: Optional[str] = None, model: Optional[str] = None,
+                        year: Optional[int] = None) -> list[str]:
+    """
+    the keys a vehicle's reviews are looked up under whichever tool asks, most specific first: make, model with its
+    variant ("ranger xlt") and year, then make, base model ("ranger") and year to fall back on. read from the listing
+    where there is one and from the description resolved against the stock vocabulary where not. a description
+    that can't be resolved is its own key
+    """
+    found_make, found_model, found_year = load_rule_based_extractor().identify(description)
+    make, model, year = make or found_make, model or found_model, year or found_year
+    if not (make and model):
+        return [review_key(variant=description)]
+    return list(dict.fromkeys([review_key(make, model, year), review_key(make, model.split()[0], year)]))
+
+
+class ReviewCache:
+    """reviews from the web keyed by vehicle, kept on disk for ttl seconds and shared across processes"""
+
+    def __init__(self, path: str = REVIEW_CACHE_PATH, ttl: int = REVIEW_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS reviews (key TEXT PRIMARY KEY, fetched_at REAL NOT NULL, reviews TEXT NOT NULL)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT reviews FROM reviews WHERE key = ? AND fetched_at > ?", (key, time.time() - self.ttl)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, reviews: dict):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO reviews (key, fetched_at, reviews) VALUES (?, ?, ?)",
+                               (key, time.time(), json.dumps(reviews)))
+            self._conn.commit()
+
+    def expire(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM reviews WHERE fetched_at <= ?", (time.time() - self.ttl,))
+            self._conn.commit()
+
+
+review_cache = ReviewCache()
+
+
+def cached_reviews(keys: list[str]) -> Optional[dict]:
+    """the fresh reviews under the first of a vehicle's keys that has any, so a variant falls back on its base model"""
+    for key in keys:
+        reviews = review_cache.get(key)
+        if reviews is not None:
+            return reviews
+    return None
+
+
+def fetch_reviews(vehicles: list[tuple[list[str], str]]) -> list[dict]:
+    """
+    reviews for each (keys, description) pair, in order. cached vehicles skip the web entirely and the rest are
+    searched concurrently, each distinct vehicle only once and stored under its most specific key
+    """
+    results = {keys[0]: cached_reviews(keys) for keys, _ in vehicles}
+    missing = {keys[0]: description for keys, description in vehicles if results[keys[0]] is None}
+    log.info(f"reviews cached for {len(results) - len(missing)} of {len(results)} vehicles")
+
+    futures = {key: executor.submit(tavily_client.search, REVIEW_QUERY_PREFIX + description)
+               for key, description in missing.items()}
+    for key, future in futures.items():
+        results[key] = future.result()
+        review_cache.put(key, results[key])
+
+    return [results[keys[0]] for keys, _ in vehicles]
+
+
+def fetch_review(description: str) -> dict:
+    return fetch_reviews([(vehicle_review_keys(description), description)])[0]
+
+
+async def afetch_reviews(vehicles: list[tuple[list[str], str]]) -> list[dict]:
+    """async fetch_reviews, misses are searched at most REVIEW_FETCH_CONCURRENCY at a time"""
+    results = {keys[0]: cached_reviews(keys) for keys, _ in vehicles}
+    missing = {keys[0]: description for keys, description in vehicles if results[keys[0]] is None}
+    log.info(f"reviews cached for {len(results) - len(missing)} of {len(results)} vehicles")
+
+    semaphore = asyncio.Semaphore(REVIEW_FETCH_CONCURRENCY)
+
+    async def search(key: str, description: str):
+        async with semaphore:
+            results[key] = await async_tavily_client.search(REVIEW_QUERY_PREFIX + description)
+        review_cache.put(key, results[key])
+
+    await asyncio.gather(*(search(key, description) for key, description in missing.items()))
+    return [results[keys[0]] for keys, _ in vehicles]
+
+
+async def afetch_review(description: str) -> dict:
+    return (await afetch_reviews([(vehicle_review_keys(description), description)]))[0]
@@ -0,0 +1,293 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+from tina.retrievers.facet_catalogue import FacetCatalogue, load_facet_catalogue
+
+log = logging.getLogger(__name__)
+
+ROLE = re.compile(r"^\s*(human|user|ai|assistant|system)\s*:\s*(.*)$", re.IGNORECASE | re.DOTALL)
+BRANCHES = re.compile(r"turners locations to search are(?:\s+are)?\s*:?\s*(.+)$", re.IGNORECASE)
+
+NUMBER = r"\$?\s*(\d[\d,]*(?:\.\d+)?)\s*(k|grand|thousand)?"
+UPPER = r"under|below|less than|max(?:imum)?|up to|no more than|cheaper than|within|budget(?: of| is)?"
+LOWER = r"over|above|more than|at least|min(?:imum)?|from"
+
+PRICE_RANGE = re.compile(rf"\$?\s*(\d[\d,]*(?:\.\d+)?)\s*(k)?\s*(?:-|to|and)\s*{NUMBER}(?!\s*(?:km|kms|kilomet))",
+                         re.IGNORECASE)
+PRICE_BOUND = re.compile(rf"\b({UPPER}|{LOWER})\s+{NUMBER}(?!\s*(?:km|kms|kilomet|\d))", re.IGNORECASE)
+PRICE_BARE = re.compile(r"(?<![\w.])(?:\$\s*(\d[\d,]*(?:\.\d+)?)\s*(k|grand|thousand)?|(\d+(?:\.\d+)?)\s*(k|grand)\b)",
+                        re.IGNORECASE)
+ODOMETER = re.compile(rf"\b(?:({UPPER}|{LOWER})\s+)?(\d[\d,]*)\s*(k)?\s*(?:km|kms|kilomet\w*)\b", re.IGNORECASE)
+YEAR_AFTER = re.compile(r"\b(?:newer than|after|since|from|at least)\s+((?:19|20)\d\d)\b|\b((?:19|20)\d\d)\s*(?:\+|or newer|or later|onwards)",
+                        re.IGNORECASE)
+YEAR_BEFORE = re.compile(r"\b(?:older than|before|up to)\s+((?:19|20)\d\d)\b", re.IGNORECASE)
+YEAR = re.compile(r"\b(?:19|20)\d\d\b")
+SEATS = re.compile(r"\b(\d{1,2})\s*(?:seats|seater)\b", re.IGNORECASE)
+
+NEGATION = re.compile(r"\b(not|no|don'?t|without|except|other than|anything but|never)\b", re.IGNORECASE)
+APPROXIMATE = re.compile(r"\b(around|about|roughly|approx\w*)\b|~", re.IGNORECASE)
+ANAPHORA = re.compile(r"\b(both|those|these|them|that one|the same|the first|the second|the last)\b", re.IGNORECASE)
+AFFIRMATION = re.compile(r"^(yes|yeah|yep|yup|sure|ok|okay|okey|please do|sounds good|that works|go ahead)\b",
+                         re.IGNORECASE)
+
+VEHICLE_TYPE_SYNONYMS = {
+    "hatch": "Hatchback", "hatchback": "Hatchback",
+    "sedan": "Sedan", "saloon": "Sedan",
+    "wagon": "Wagon", "station wagon": "Wagon", "estate": "Wagon",
+    "suv": "SUV", "4x4": "SUV",
+    "ute": "Utility", "utility": "Utility", "pickup": "Utility", "pick up": "Utility",
+    "convertible": "Convertible", "cabrio": "Convertible",
+    "sports car": "Sports Car", "coupe": "Sports Car",
+    "van": "Van", "people mover": "Van",
+}
+FUEL_SYNONYMS = {
+    "petrol": "Petrol", "gas": "Petrol", "gasoline": "Petrol",
+    "diesel": "Diesel",
+    "hybrid": "Hybrid",
+    "electric": "Electric", "ev": "Electric",
+}
+MAKE_ALIASES = {"vw": "Volkswagen", "merc": "Mercedes-Benz", "mercedes": "Mercedes-Benz", "benz": "Mercedes-Benz",
+                "chevy": "Chevrolet", "beemer": "BMW"}
+
+# model names that are also ordinary words only count when their make has been mentioned
+COMMON_WORDS = {"note", "life", "move", "fit", "jazz", "leaf", "caravan", "daily", "town", "crossroad", "bongo",
+                "spacia", "cube", "march", "tiida", "wish", "one", "pop", "sport", "van", "estate", "touring"}
+
+FILLER = {"i", "im", "i'm", "id", "i'd", "me", "my", "a", "an", "the", "and", "or", "to", "for", "of", "in", "is",
+          "it", "with", "want", "wanted", "would", "like", "looking", "look", "need", "get", "buy", "find", "something",
+          "some", "one", "any", "please", "can", "you", "show", "am", "be", "that", "has", "have", "at", "on",
+          "also", "maybe", "just", "really", "okey", "ok", "okay", "yes", "hi", "hey", "hello", "price", "budget",
+          "under", "below", "over", "above", "around", "about", "between", "max", "min", "actually", "instead",
+          "make", "change", "k", "kms", "km", "$"}
+
+
+@dataclass
+class Extraction:
+    result: dict
+    confidence: float
+    reasons: list = field(default_factory=list)
+
+
+def _money(number: str, suffix: Optional[str]) -> float:
+    value = float(number.replace(",", ""))
+    return value * 1000 if suffix else value
+
+
+def _phrase_pattern(phrase: str) -> re.Pattern:
+    return re.compile(rf"(?<![\w-]){re.escape(phrase)}(?![\w-])", re.IGNORECASE)
+
+
+class RuleBasedQueryExtractor:
+    """
+    turns simple conversations into the same {query, filter} grammar the LLM extractor produces,
+    using regexes for price/year/odometer and dictionaries drawn from the inventory facets.
+    every extraction carries a confidence so callers can fall back to the LLM for anything subtle.
+    """
+
+    def __init__(self, catalogue: FacetCatalogue):
+        self.makes = {make.casefold(): make for make in catalogue.counts["make"]}
+        for alias, make in MAKE_ALIASES.items():
+            if make in catalogue.counts["make"]:
+                self.makes.setdefault(alias, make)
+        for make in catalogue.counts["make"]:
+            first = re.split(r"[\s-]", make)[0].casefold()
+            if len(first) > 2:
+                self.makes.setdefault(first, make)
+
+        # a model's first word ("corolla") stands for every variant ("Corolla GX", "Corolla Touring", ...)
+        self.models: dict[str, tuple[str, list[str]]] = {}
+        for make, models in catalogue.make_to_models.items():
+            for model in models:
+                base = model.split()[0].casefold()
+                if len(base) < 3 or not re.search(r"[a-z]", base):
+                    continue
+                variants = self.models.setdefault(base, (make, []))[1]
+                variants.append(model)
+
+        self.locations = {location.casefold(): location for location in catalogue.counts["location"]}
+        self.vehicle_types = dict(VEHICLE_TYPE_SYNONYMS)
+        self.vehicle_types.update({t.casefold(): t for t in catalogue.counts["vehicle_type"]})
+        self.fuels = {k: v for k, v in FUEL_SYNONYMS.items() if v in catalogue.counts["fuel"]}
+        self.fuels.update({f.casefold(): f for f in catalogue.counts["fuel"]})
+
+        self._patterns = {
+            name: sorted(((_phrase_pattern(p), p) for p in vocabulary), key=lambda x: -len(x[1]))
+            for name, vocabulary in [("make", self.makes), ("model", self.models), ("location", self.locations),
+                                     ("vehicle_type", self.vehicle_types), ("fuel", self.fuels)]
+        }
+
+    @staticmethod
+    def split_turns(conversation: list) -> list[tuple[str, str]]:
+        turns = []
+        for line in conversation:
+            match = ROLE.match(str(line))
+            if match:
+                role = match.group(1).lower()
+                turns.append(("ai" if role in ("ai", "assistant") else "system" if role == "system" else "human",
+                              match.group(2).strip()))
+            else:
+                turns.append(("human", str(line).strip()))
+        return turns
+
+    def _find(self, name: str, text: str) -> tuple[list[str], str]:
+        found = []
+        for pattern, phrase in self._patterns[name]:
+            if pattern.search(text):
+                found.append(phrase)
+                text = pattern.sub(" ", text)
+        return found, text
+
+    def identify(self, text: str) -> tuple[Optional[str], Optional[str], Optional[int]]:
+        """
+        the make, model and year a free text vehicle description names, as far as the stock knows. the model is the
+        stock variant the text names ("Ranger XLT") where it names one and the base model ("ranger") where not
+        """
+        makes, rest = self._find("make", text)
+        make = self.makes[makes[0]] if makes else None
+        model = None
+        for base in self._find("model", rest)[0]:
+            model_make, variants = self.models[base]
+            if make in (None, model_make) and (base not in COMMON_WORDS or make):
+                named = [v for v in variants if _phrase_pattern(v).search(rest)]
+                make, model = model_make, max(named, key=len) if named else base
+                break
+        year = YEAR.search(text)
+        return make, model, int(year.group(0)) if year else None
+
+    def extract(self, conversation: list) -> Extraction:
+        conditions: dict[str, dict] = {}
+        query_parts = []
+        confidence = 1.0
+        reasons = []
+
+        def cap(value: float, reason: str):
+            nonlocal confidence
+            confidence = min(confidence, value)
+            reasons.append(reason)
+
+        for role, text in self.split_turns(conversation):
+            if role == "ai":
+                branches = BRANCHES.search(text)
+                if branches:
+                    names = [n.strip(" .") for n in re.split(r",|\band\b", branches.group(1)) if n.strip(" .")]
+                    conditions["location"] = {"$in": names}
+                continue
+            if role != "human" or not text:
+                continue
+
+            turn_conditions, remaining = self._extract_turn(text, cap)
+            if not turn_conditions and AFFIRMATION.match(text):
+                cap(0.4, f"reply depends on what the ai asked: {text!r}")
+            conditions.update(turn_conditions)
+
+            words = [w for w in re.findall(r"[\w'$]+", remaining.casefold()) if w not in FILLER]
+            if any(re.fullmatch(r"\$?\d[\d,.]*", w) for w in words):
+                cap(0.5, f"unparsed numbers in: {text!r}")
+            words = [w for w in words if not re.fullmatch(r"\$?\d[\d,.]*", w)]
+            if words:
+                query_parts.append(" ".join(words))
+
+        query = ", ".join(query_parts) or "any car"
+        if len(query.split()) > 20:
+            cap(0.6, "long free text query")
+
+        result = {
+            "query": query,
+            "filter": {"$and": [{k: v} for k, v in conditions.items()]} if conditions else "NO_FILTER",
+        }
+        return Extraction(result=result, confidence=confidence, reasons=reasons)
+
+    def _extract_turn(self, text: str, cap) -> tuple[dict, str]:
+        conditions = {}
+        if NEGATION.search(text):
+            cap(0.3, f"negation in: {text!r}")
+        if APPROXIMATE.search(text):
+            cap(0.6, f"approximate value in: {text!r}")
+        if ANAPHORA.search(text):
+            cap(0.5, f"refers back to earlier suggestions: {text!r}")
+
+        def take(pattern: re.Pattern, handler):
+            nonlocal text
+            for match in list(pattern.finditer(text)):
+                handler(match)
+            text = pattern.sub(" ", text)
+
+        def odometer(m):
+            value = _money(m.group(2), m.group(3))
+            bound = m.group(1)
+            op = "$gt" if bound and re.match(LOWER, bound, re.IGNORECASE) else "$lt"
+            conditions["odometer"] = {op: int(value)}
+
+        def year_after(m):
+            year = int(m.group(1) or m.group(2))
+            conditions.setdefault("year", {})["$gte"] = year
+
+        def year_before(m):
+            conditions.setdefault("year", {})["$lt"] = int(m.group(1))
+
+        def price_range(m):
+            upper = _money(m.group(3), m.group(4))
+            lower = _money(m.group(1), m.group(2) or m.group(4))
+            conditions["price"] = {"$gte": lower, "$lte": upper}
+
+        def price_bound(m):
+            value = _money(m.group(2), m.group(3))
+            op = "$gt" if re.match(LOWER, m.group(1), re.IGNORECASE) else "$lt"
+            conditions["price"] = {op: value}
+
+        def price_bare(m):
+            value = _money(m.group(1), m.group(2)) if m.group(1) else _money(m.group(3), m.group(4))
+            conditions["price"] = {"$lte": value}
+
+        def seats(m):
+            conditions["seats"] = {"$gte": int(m.group(1))}
+
+        take(ODOMETER, odometer)
+        take(YEAR_AFTER, year_after)
+        take(YEAR_BEFORE, year_before)
+        take(SEATS, seats)
+        take(PRICE_RANGE, price_range)
+        take(PRICE_BOUND, price_bound)
+        take(PRICE_BARE, price_bare)
+
+        makes, text = self._find("make", text)
+        makes = list(dict.fromkeys(self.makes[m] for m in makes))
+        if makes:
+            conditions["make"] = {"$eq": makes[0]} if len(makes) == 1 else {"$in": makes}
+
+        models, _ = self._find("model", text)
+        variants = []
+        for base in models:
+            make, names = self.models[base]
+            if base in COMMON_WORDS and make not in makes:
+                continue
+            if makes and make not in makes:
+                cap(0.5, f"{base} is not made by {', '.join(makes)}")
+            variants.extend(names)
+            text = _phrase_pattern(base).sub(" ", text)
+        if variants:
+            conditions["model"] = {"$in": variants}
+
+        for name in ("location", "vehicle_type", "fuel"):
+            found, text = self._find(name, text)
+            vocabulary = {"location": self.locations, "vehicle_type": self.vehicle_types, "fuel": self.fuels}[name]
+            values = list(dict.fromkeys(vocabulary[f] for f in found))
+            if values:
+                conditions[name] = {"$eq": values[0]} if len(values) == 1 else {"$in": values}
+
+        return conditions, text
+
+
+_cache: dict[str, tuple[tuple, RuleBasedQueryExtractor]] = {}
+
+
+def load_rule_based_extractor() -> RuleBasedQueryExtractor:
+    """rebuilt whenever the facet catalogue moves on so the dictionaries follow the stock"""
+    catalogue = load_facet_catalogue()
+    version = (id(catalogue), catalogue.version)
+    cached = _cache.get("extractor")
+    if cached is None or cached[0] != version:
+        cached = _cache["extractor"] = (version, RuleBasedQueryExtractor(catalogue))
+    return cached[1]
@@ -0,0 +1,158 @@
+import json
+import logging
+import re
+from typing import Optional, Sequence
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from tina.retrievers.query_extractor import QueryExtractor
+from tina.retrievers.rule_based_extractor import load_rule_based_extractor
+from tina.retrievers.utils import message_text
+
+log = logging.getLogger(__name__)
+
+MAX_QUERY_PARTS = 5
+# a field given this value in a turn's filter is dropped from the criteria
+NO_FILTER = "NO_FILTER"
+
+FIELD_WORDS = {
+    "price": "price", "budget": "price", "make": "make", "brand": "make", "model": "model", "year": "year",
+    "age": "year", "km": "odometer", "kms": "odometer", "mileage": "odometer", "odometer": "odometer",
+    "location": "location", "branch": "location", "branches": "location", "colour": "colour", "color": "colour",
+    "fuel": "fuel", "type": "vehicle_type", "body": "vehicle_type", "seats": "seats", "drive": "drive",
+}
+ANY_FIELD = re.compile(
+    rf"\b(?:any|whatever|no preference on|don'?t care about|not fussed about)\s+(?:the\s+)?({'|'.join(FIELD_WORDS)})\b"
+    r"(?:\s+(?:is|are|will do|works)(?:\s+(?:fine|ok|okay|good))?)?", re.IGNORECASE)
+FORGET = re.compile(r"\b(?:forget|ignore|never ?mind|not fussed about)\s+(?:about\s+)?(?:the\s+)?([^.,;!?]+)", re.IGNORECASE)
+# words that carry nothing to search on, a turn made only of these isn't worth an llm call
+CHATTER = {"no", "nope", "nah", "not", "thanks", "thank", "cheers", "that's", "thats", "all", "bye", "good", "great",
+           "fine", "cool", "nice", "awesome", "perfect", "sorry", "right", "alright", "now", "for", "today", "done"}
+
+
+def empty_criteria() -> dict:
+    return {"conditions": {}, "query": [], "last_message_id": None}
+
+
+def flatten_filter(filter) -> tuple[dict, list]:
+    """split an extracted filter into per field conditions, and any clauses that can't be keyed by field"""
+    if not isinstance(filter, dict):
+        return {}, []
+
+    clauses = filter["$and"] if list(filter) == ["$and"] else [{k: v} for k, v in filter.items()]
+    conditions, other = {}, []
+    for clause in clauses:
+        if len(clause) == 1 and not next(iter(clause)).startswith("$"):
+            conditions.update(clause)
+        else:
+            other.append(clause)
+    return conditions, other
+
+
+def fold(criteria: dict, extraction: dict) -> dict:
+    """merge one turn's extraction into the running criteria, newer conditions replacing older ones per field"""
+    conditions, other = flatten_filter(extraction.get("filter"))
+    merged = {**criteria["conditions"], **conditions}
+    for field, value in conditions.items():
+        if value == NO_FILTER:
+            del merged[field]
+    if other:
+        merged["$clauses"] = other
+
+    query = [part for part in criteria["query"] if part != extraction.get("query")]
+    if extraction.get("query") and extraction["query"] != "any car":
+        query.append(extraction["query"])
+    return {**criteria, "conditions": merged, "query": query[-MAX_QUERY_PARTS:]}
+
+
+def render(criteria: dict) -> str:
+    return f"query: {', '.join(criteria['query']) or 'any car'}; filter: {json.dumps(criteria['conditions'])}"
+
+
+def released_fields(human: str) -> tuple[list[str], str]:
+    """the fields a turn lets go of ("any price is fine", "forget the toyota"), and the turn without those phrases"""
+    fields = [FIELD_WORDS[m.group(1).casefold()] for m in ANY_FIELD.finditer(human)]
+
+    def forget(match: re.Match) -> str:
+        phrase = match.group(1)
+        # "forget 20k, make it 15k" changes the value rather than dropping it
+        if re.search(r"\d", phrase):
+            return match.group(0)
+        fields.extend(FIELD_WORDS[w] for w in re.findall(r"\w+", phrase.casefold()) if w in FIELD_WORDS)
+        fields.extend(flatten_filter(load_rule_based_extractor().extract([phrase]).result["filter"])[0])
+        return " "
+
+    text = FORGET.sub(forget, ANY_FIELD.sub(" ", human))
+    return list(dict.fromkeys(fields)), text
+
+
+def has_search_content(result: dict) -> bool:
+    query = result.get("query") or "any car"
+    words = [] if query == "any car" else re.findall(r"[\w']+", query.casefold())
+    return result.get("filter") != NO_FILTER or any(word not in CHATTER for word in words)
+
+
+def release(result: dict, fields: list[str]) -> dict:
+    """mark the released fields NO_FILTER, whatever the extraction made of them"""
+    if not fields:
+        return result
+    conditions, other = flatten_filter(result.get("filter"))
+    clauses = [{k: v} for k, v in conditions.items() if k not in fields] + other
+    return {**result, "filter": {"$and": clauses + [{field: NO_FILTER} for field in fields]}}
+
+
+def extract_turn(criteria: dict, previous_ai: Optional[str], human: str) -> dict:
+    """extract a single human turn, seeing only the current criteria and the ai line it answers"""
+    released, human = released_fields(human)
+    turn = ([f"ai: {previous_ai}"] if previous_ai else []) + [f"human: {human}"]
+    extraction = load_rule_based_extractor().extract(turn)
+    if extraction.confidence >= QueryExtractor.confidence_threshold:
+        return release(extraction.result, released)
+    if not has_search_content(extraction.result):
+        # "no thanks" and the like, there is nothing here for the llm to find
+        return release({"query": "any car", "filter": NO_FILTER}, released)
+
+    log.info(f"falling back to llm for turn ({extraction.confidence}): {extraction.reasons}")
+    context = f"system: the search so far is {render(criteria)}. give a filter the customer no longer wants the value {NO_FILTER}"
+    return release(QueryExtractor().extract_query_with_llm([context] + turn), released)
+
+
+def update_criteria(criteria: Optional[dict], messages: Sequence[BaseMessage]) -> dict:
+    """fold every human message after the last one seen into the criteria"""
+    criteria = criteria or empty_criteria()
+
+    # scan back from the end, the last message we folded is only ever a few messages ago
+    start = 0
+    if criteria["last_message_id"] is not None:
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].id == criteria["last_message_id"]:
+                start = i + 1
+                break
+
+    previous_ai = None
+    for i in range(start - 1, -1, -1):
+        if isinstance(messages[i], AIMessage) and message_text(messages[i]):
+            previous_ai = message_text(messages[i])
+            break
+
+    for message in messages[start:]:
+        if isinstance(message, AIMessage) and message_text(message):
+            previous_ai = message_text(message)
+        elif isinstance(message, HumanMessage) and message_text(message):
+            criteria = fold(criteria, extract_turn(criteria, previous_ai, message_text(message)))
+            criteria = {**criteria, "last_message_id": message.id}
+    return criteria
+
+
+def criteria_query(criteria: dict, locations: Optional[list[str]] = None) -> dict:
+    """the {query, filter} to search with, optionally narrowed to a set of branches"""
+    conditions = dict(criteria["conditions"])
+    if locations:
+        conditions["location"] = {"$in": locations}
+
+    clauses = [{k: v} for k, v in conditions.items() if k != "$clauses"]
+    clauses.extend(conditions.get("$clauses", []))
+    return {
+        "query": ", ".join(criteria["query"]) or "any car",
+        "filter": {"$and": clauses} if clauses else "NO_FILTER",
+    }
@@ -0,0 +1,42 @@
+import logging
+import math
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+
+log = logging.getLogger(__name__)
+
+# rough characters per token for english text, used when the tokenizer files can't be loaded (eg offline)
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def encoding(name: str = "o200k_base") -> Optional[tiktoken.Encoding]:
+    """the tokenizer gpt-4o uses, so budgets measured here match what the model sees"""
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        log.warning(f"unable to load tokenizer {name}, estimating token counts instead: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = encoding()
+    if enc is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    if budget <= 0:
+        return ""
+    enc = encoding()
+    if enc is None:
+        limit = budget * CHARS_PER_TOKEN
+        return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= budget:
+        return text
+    return enc.decode(tokens[:budget]).rstrip() + "…"
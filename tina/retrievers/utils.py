@@ -1,6 +1,29 @@
+from typing import Optional
+
+
 def escape_f_string(text):
     return text.replace('{', '{{').replace('}', '}}')
 
 
 def escape_examples(examples):
     return [{k: escape_f_string(v) for k, v in example.items()} for example in examples]
+
+
+def message_text(message) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return " ".join(part.get("text", "") for part in message.content if isinstance(part, dict))
+
+
+def to_chat_history(messages: list, summary: Optional[str] = None) -> list[str]:
+    """
+    render graph messages as the "human: ..." / "ai: ..." lines the prompts expect, leaving out tool traffic.
+    the summary of turns already folded out of the messages leads, so what was said early on isn't lost
+    """
+    history = [f"system: summary of the earlier conversation: {summary}"] if summary else []
+    for message in messages:
+        if isinstance(message, str):
+            history.append(message)
+        elif message.type in ("human", "ai") and message_text(message):
+            history.append(f"{message.type}: {message_text(message)}")
+    return history
@@ -0,0 +1,376 @@
+import atexit
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+VECTOR_INDEX_BACKEND = os.environ.get("VECTOR_INDEX_BACKEND", "pinecone")
+LOCAL_VECTOR_INDEX_DIR = os.environ.get("LOCAL_VECTOR_INDEX_DIR", "db/vectors")
+LOCAL_VECTOR_INDEX_DTYPE = os.environ.get("LOCAL_VECTOR_INDEX_DTYPE", "float32")
+LOCAL_VECTOR_INDEX_MODE = os.environ.get("LOCAL_VECTOR_INDEX_MODE", "exact")
+# rows scored per matmul when the index is stored in a narrower dtype than float32
+SCORE_BLOCK_ROWS = int(os.environ.get("LOCAL_VECTOR_INDEX_SCORE_BLOCK_ROWS", "1024"))
+
+COMPARISONS = {
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal,
+}
+
+
+class LocalVectorIndex:
+    """
+    an embedded stand in for a pinecone index. vectors live in a (memory mapped) matrix and
+    queries are answered by brute force matmul, or by probing the nearest IVF cells when
+    the index has been built in ivf mode. supports pinecone's mongo style metadata filters.
+    writes only change memory, they reach disk on save() (and at exit) and the IVF cells are
+    rebuilt by the first query after them, so a bulk load costs one flush and one clustering.
+    a save from another process (the scraper) is picked up by the next call that reads the index.
+    """
+
+    def __init__(self, path: str, dtype: str = LOCAL_VECTOR_INDEX_DTYPE, mode: str = LOCAL_VECTOR_INDEX_MODE,
+                 nlist: Optional[int] = None, nprobe: int = 8):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.mode = mode
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+
+        self.ids: list[str] = []
+        self.metadata: list[dict] = []
+        # rows below len(ids) are live, the rest is room to append into
+        self._buffer = None
+        self._dirty = False
+        self._loaded_generation = None
+        self._positions: dict[str, int] = {}
+        self._columns: dict[str, tuple] = {}
+        self._centroids = None
+        self._assignments = None
+        self._load()
+        atexit.register(self.save)
+
+    @property
+    def vectors(self):
+        return self._buffer[:len(self.ids)] if self._buffer is not None else None
+
+    # storage
+
+    @property
+    def _vectors_file(self):
+        return os.path.join(self.path, "vectors.npy")
+
+    @property
+    def _records_file(self):
+        return os.path.join(self.path, "records.json")
+
+    @property
+    def generation(self) -> Optional[tuple]:
+        if not (os.path.exists(self._vectors_file) and os.path.exists(self._records_file)):
+            return None
+        vectors, records = os.stat(self._vectors_file), os.stat(self._records_file)
+        return vectors.st_mtime_ns, vectors.st_size, records.st_mtime_ns, records.st_size
+
+    def _load(self):
+        generation = self.generation
+        if generation is not None:
+            buffer = np.load(self._vectors_file, mmap_mode="r")
+            with open(self._records_file) as f:
+                records = json.load(f)
+            # the two files are replaced one after the other, a load between them is retried on the next call
+            if len(buffer) != len(records["ids"]) or generation != self.generation:
+                return
+            self._buffer = buffer
+            self.ids = records["ids"]
+            self.metadata = records["metadata"]
+        self._loaded_generation = generation
+        self._reindex()
+        log.info(f"loaded local vector index {self.path} with {len(self.ids)} vectors")
+
+    def _refresh(self):
+        """reload when another process has saved the index since it was loaded, unsaved writes here win"""
+        generation = self.generation
+        if generation == self._loaded_generation:
+            return
+        with self._lock:
+            if generation != self._loaded_generation and not self._dirty:
+                self._load()
+
+    def _flush(self):
+        os.makedirs(self.path, exist_ok=True)
+        vectors_tmp = self._vectors_file + ".tmp.npy"
+        records_tmp = self._records_file + ".tmp"
+        np.save(vectors_tmp, self.vectors if self.vectors is not None else np.zeros((0, 0), dtype=self.dtype))
+        with open(records_tmp, "w") as f:
+            json.dump({"ids": self.ids, "metadata": self.metadata}, f)
+        os.replace(vectors_tmp, self._vectors_file)
+        os.replace(records_tmp, self._records_file)
+        self._loaded_generation = self.generation
+
+    def save(self):
+        """write out any changes since the last save"""
+        with self._lock:
+            if self._dirty:
+                self._flush()
+                self._dirty = False
+
+    def _reindex(self):
+        self._positions = {id_: i for i, id_ in enumerate(self.ids)}
+        self._changed()
+
+    def _changed(self):
+        self._columns = {}
+        self._centroids = None
+        self._assignments = None
+
+    def _reserve(self, rows: int, dimension: int):
+        """make room for rows more vectors, growing geometrically so appending stays amortised O(1)"""
+        needed = len(self.ids) + rows
+        # the loaded file is a read only memory map, it is copied into memory on the first write
+        if self._buffer is not None and not isinstance(self._buffer, np.memmap) and len(self._buffer) >= needed:
+            return
+        current = len(self._buffer) if self._buffer is not None else 0
+        buffer = np.empty((max(needed, 2 * current, 64), dimension), dtype=self.dtype)
+        if len(self.ids):
+            buffer[:len(self.ids)] = self._buffer[:len(self.ids)]
+        self._buffer = buffer
+
+    # pinecone Index api
+
+    def upsert(self, vectors: Iterable, namespace: str = None, **kwargs) -> dict:
+        items = [_as_record(v) for v in vectors]
+        if not items:
+            return {"upserted_count": 0}
+
+        with self._lock:
+            self._refresh()
+            self._reserve(len(items), len(items[0][1]))
+            for id_, values, metadata in items:
+                position = self._positions.get(id_)
+                if position is not None:
+                    self.metadata[position] = metadata
+                else:
+                    position = self._positions[id_] = len(self.ids)
+                    self.ids.append(id_)
+                    self.metadata.append(metadata)
+                self._buffer[position] = _normalise(np.asarray(values, dtype=np.float32))
+            self._dirty = True
+            self._changed()
+        return {"upserted_count": len(items)}
+
+    def delete(self, ids: Optional[list[str]] = None, delete_all: bool = False, filter: Optional[dict] = None,
+               namespace: str = None, **kwargs) -> dict:
+        with self._lock:
+            self._refresh()
+            if delete_all:
+                keep = np.zeros(len(self.ids), dtype=bool)
+            else:
+                keep = np.ones(len(self.ids), dtype=bool)
+                for id_ in ids or []:
+                    if id_ in self._positions:
+                        keep[self._positions[id_]] = False
+                if filter:
+                    keep &= ~self._mask(filter)
+
+            if keep.all():
+                return {}
+            positions = np.flatnonzero(keep)
+            self._buffer = np.array(self._buffer[positions], dtype=self.dtype) if self._buffer is not None else None
+            self.ids = [self.ids[i] for i in positions]
+            self.metadata = [self.metadata[i] for i in positions]
+            self._dirty = True
+            self._reindex()
+        return {}
+
+    def list(self, prefix: str = "", limit: int = 100, namespace: str = None, **kwargs):
+        """yields pages of ids starting with the prefix, like pinecone's list"""
+        self._refresh()
+        matching = [id_ for id_ in self.ids if id_.startswith(prefix)]
+        for i in range(0, len(matching), limit):
+            yield matching[i:i + limit]
+
+    def fetch(self, ids: List[str], namespace: str = None, **kwargs) -> dict:
+        self._refresh()
+        vectors = {}
+        with self._lock:
+            for id_ in ids:
+                position = self._positions.get(id_)
+                if position is not None:
+                    vectors[id_] = {
+                        "id": id_,
+                        "values": self.vectors[position].astype(np.float32).tolist(),
+                        "metadata": self.metadata[position],
+                    }
+        return {"vectors": vectors, "namespace": namespace or ""}
+
+    def describe_index_stats(self, **kwargs) -> dict:
+        self._refresh()
+        dimension = int(self.vectors.shape[1]) if self.vectors is not None and len(self.ids) else 0
+        return {"dimension": dimension, "total_vector_count": len(self.ids), "namespaces": {}}
+
+    def query(self, vector: List[float], filter: Optional[dict] = None, top_k: int = 10,
+              include_metadata: bool = False, include_values: bool = False, namespace: str = None,
+              **kwargs) -> dict:
+        self._refresh()
+        query = _normalise(np.asarray(vector, dtype=np.float32))
+        # one consistent view of the index: deletes and reloads swap in new lists and buffers, and upserts only
+        # append past it or rewrite a row in place, so its positions stay valid once the lock is released
+        with self._lock:
+            if not self.ids:
+                return {"matches": [], "namespace": namespace or ""}
+            if self.mode == "ivf" and self._centroids is None:
+                self.build_ivf()
+            ids, metadata, vectors = self.ids, self.metadata, self.vectors
+            candidates = self._mask(filter) if filter else np.ones(len(ids), dtype=bool)
+            if self._centroids is not None:
+                cells = np.argsort(-(self._centroids @ query))[:self.nprobe]
+                candidates &= np.isin(self._assignments, cells)
+
+        positions = np.flatnonzero(candidates)
+        if len(positions) == 0:
+            return {"matches": [], "namespace": namespace or ""}
+
+        scores = _scores(vectors, query, None if len(positions) == len(vectors) else positions)
+        k = min(top_k, len(positions))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+
+        matches = []
+        for i in best:
+            position = int(positions[i])
+            match = {"id": ids[position], "score": float(scores[i])}
+            if include_metadata:
+                match["metadata"] = metadata[position]
+            if include_values:
+                match["values"] = vectors[position].astype(np.float32).tolist()
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace or ""}
+
+    # ivf
+
+    def build_ivf(self, nlist: Optional[int] = None, iterations: int = 10, seed: int = 0):
+        """cluster the stock with a few rounds of spherical k-means so queries only scan nearby cells"""
+        vectors = np.asarray(self.vectors, dtype=np.float32)
+        nlist = min(nlist or self.nlist or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            for cell in range(nlist):
+                members = vectors[assignments == cell]
+                if len(members):
+                    centroids[cell] = _normalise(members.mean(axis=0))
+        self._centroids = centroids
+        self._assignments = np.argmax(vectors @ centroids.T, axis=1)
+
+    # metadata filters
+
+    def _column(self, field: str):
+        column = self._columns.get(field)
+        if column is None:
+            values = np.array([m.get(field) for m in self.metadata], dtype=object)
+            numbers = np.array([_as_float(v) for v in values], dtype=np.float64)
+            column = self._columns[field] = (values, numbers)
+        return column
+
+    def _mask(self, filter: dict) -> np.ndarray:
+        mask = np.ones(len(self.ids), dtype=bool)
+        for key, condition in filter.items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self._mask(clause)
+            elif key == "$or":
+                any_mask = np.zeros(len(self.ids), dtype=bool)
+                for clause in condition:
+                    any_mask |= self._mask(clause)
+                mask &= any_mask
+            elif key.startswith("$"):
+                raise ValueError(f"unsupported filter operator: {key}")
+            else:
+                mask &= self._field_mask(key, condition)
+        return mask
+
+    def _field_mask(self, field: str, condition) -> np.ndarray:
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+
+        values, numbers = self._column(field)
+        mask = np.ones(len(self.ids), dtype=bool)
+        for op, operand in condition.items():
+            if op == "$eq":
+                mask &= values == operand
+            elif op == "$ne":
+                mask &= values != operand
+            elif op == "$in":
+                mask &= np.logical_or.reduce([values == o for o in operand]) if operand else False
+            elif op == "$nin":
+                for o in operand:
+                    mask &= values != o
+            elif op == "$exists":
+                mask &= (values != None) == bool(operand)  # noqa: E711 elementwise comparison
+            elif op in COMPARISONS:
+                mask &= COMPARISONS[op](numbers, float(operand))
+            else:
+                raise ValueError(f"unsupported filter operator: {op}")
+        return mask
+
+
+def _normalise(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _scores(vectors: np.ndarray, query: np.ndarray, positions: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    the float32 query against the given rows (all of them by default). a narrower dtype is only how the vectors are
+    stored, its rows are widened to float32 a block at a time since half precision matmul has no fast path in numpy
+    """
+    if vectors.dtype == np.float32:
+        return (vectors if positions is None else vectors[positions]) @ query
+    rows = len(vectors) if positions is None else len(positions)
+    scores = np.empty(rows, dtype=np.float32)
+    for start in range(0, rows, SCORE_BLOCK_ROWS):
+        block = vectors[start:start + SCORE_BLOCK_ROWS] if positions is None \
+            else vectors[positions[start:start + SCORE_BLOCK_ROWS]]
+        scores[start:start + SCORE_BLOCK_ROWS] = block.astype(np.float32) @ query
+    return scores
+
+
+def _as_float(value) -> float:
+    if isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _as_record(vector) -> tuple[str, list[float], dict]:
+    if isinstance(vector, dict):
+        return vector["id"], vector["values"], vector.get("metadata") or {}
+    id_, values, *rest = vector
+    return id_, values, rest[0] if rest else {}
+
+
+def save_index(index):
+    """persist the pending writes of a local index at the end of a bulk operation, pinecone's are already durable"""
+    if isinstance(index, LocalVectorIndex):
+        index.save()
+
+
+@lru_cache(maxsize=None)
+def get_vector_index(name: str):
+    """the vector index for name, on pinecone or embedded locally depending on VECTOR_INDEX_BACKEND"""
+    if VECTOR_INDEX_BACKEND == "local":
+        return LocalVectorIndex(os.path.join(LOCAL_VECTOR_INDEX_DIR, name))
+
+    from pinecone import Pinecone
+    pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT_REGION"])
+    return pc.Index(name)
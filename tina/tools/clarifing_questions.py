@@ -1,14 +1,15 @@
 import logging
 from enum import Enum
-from typing import List
+from typing import Annotated, List, Optional
 
 from langchain.chat_models import init_chat_model
 from langchain_core.prompts import FewShotPromptWithTemplates, PromptTemplate
 from langchain_core.tools import StructuredTool
+from langgraph.prebuilt import InjectedState
 from pydantic import BaseModel, Field
 
 from tina.retrievers.query_extractor import QueryExtractor
-from tina.retrievers.utils import escape_examples
+from tina.retrievers.utils import escape_examples, to_chat_history
 from tina.tools.templates import clarifying_question_prefix, clarifying_question_examples, \
     clarifying_question_example_template
 
@@ -23,6 +24,11 @@ class QuestionType(str, Enum):
     true_false = 'True/False'
     freeform = 'freeform'
 
+class ClarifyingQuestionInput(BaseModel):
+    messages: Annotated[list, InjectedState("messages")]
+    summary: Annotated[Optional[str], InjectedState("summary")] = None
+
+
 class ClarifyingQuestionResult(BaseModel):
     question: str = Field(description="")
     question_type: QuestionType = Field(description="")
@@ -47,30 +53,40 @@ CLARIFYING_QUESTION_EXAMPLE_PROMPT = PromptTemplate(
     )
 
 
-def clarifying_question(chat_history: List[str]):
-    prompt = FewShotPromptWithTemplates(
-        suffix=suffix,
-        prefix=prefix,
-        input_variables=["metadata", "chat_history"],
-        examples=escape_examples(clarifying_question_examples),
-        example_prompt=CLARIFYING_QUESTION_EXAMPLE_PROMPT,
-        example_separator="\n",
-    )
+prompt = FewShotPromptWithTemplates(
+    suffix=suffix,
+    prefix=prefix,
+    input_variables=["metadata", "chat_history"],
+    examples=escape_examples(clarifying_question_examples),
+    example_prompt=CLARIFYING_QUESTION_EXAMPLE_PROMPT,
+    example_separator="\n",
+)
+chain = prompt | llm.with_structured_output(ClarifyingQuestionResult)
+
 
-    structured_llm = llm.with_structured_output(ClarifyingQuestionResult)
-    chain = prompt | structured_llm
+def clarifying_question(messages: list, summary: Optional[str] = None):
+    chat_history = to_chat_history(messages, summary)
     response: dict | ClarifyingQuestionResult = chain.invoke({'metadata': QueryExtractor().metadata_field_info, 'chat_history': chat_history})
     log.info(f'response: {response}')
     return response.model_dump()
 
 
+async def aclarifying_question(messages: list, summary: Optional[str] = None):
+    chat_history = to_chat_history(messages, summary)
+    response: dict | ClarifyingQuestionResult = await chain.ainvoke({'metadata': QueryExtractor().metadata_field_info, 'chat_history': chat_history})
+    log.info(f'response: {response}')
+    return response.model_dump()
+
+
 clarifying_question_tool_name = 'ClarifyingQuestion'
 clarifying_question_tool = StructuredTool.from_function(
     func=clarifying_question,
+    coroutine=aclarifying_question,
     name=clarifying_question_tool_name,
     description="""
     Useful for getting clarifying questions from a user who is looking for a vehicle
-    """
+    """,
+    args_schema=ClarifyingQuestionInput,
 )
 
 if __name__ == '__main__':
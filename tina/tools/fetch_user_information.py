@@ -1,38 +1,33 @@
-import json
-
-from langchain_core.runnables import ensure_config
+from langchain_core.runnables import RunnableConfig, ensure_config
 from langchain_core.tools import StructuredTool
-from tinydb import TinyDB, Query
 
 from tina.model.user_profile import UserProfile
+from tina.profile_service import profile_service
 import logging
 log = logging.getLogger(__name__)
-db = TinyDB('db/user.json')
 
 
-def fetch_user_information() -> UserProfile:
-    config = ensure_config()
+def configured_user_id(config: RunnableConfig = None) -> str:
+    config = ensure_config(config)
     configuration = config.get("configurable", {})
     user_id = configuration.get("user_id", None)
     log.info(f"user_id:{user_id}")
     if not user_id:
         raise ValueError("No user ID configured")
+    return user_id
+
+
+def fetch_user_information() -> UserProfile:
+    return profile_service.get(configured_user_id())
+
 
-    query = Query()
-    user = db.search(query.id == user_id)
-    if len(user) > 0:
-        return UserProfile(**user[0])
-    else:
-        profile = UserProfile(
-            user_id=user_id,
-            name=""
-        )
-        db.insert(profile.dict())
-        return profile
+async def afetch_user_information() -> UserProfile:
+    return await profile_service.aget(configured_user_id())
 
 
 fetch_user_information_tool = StructuredTool.from_function(
     func=fetch_user_information,
+    coroutine=afetch_user_information,
     name="fetch_user_information",
     description="""
         Fetches known information about a user including the user id
@@ -1,10 +1,7 @@
-import os
-
 from langchain_core.tools import StructuredTool
-from tavily import TavilyClient
 from pydantic import BaseModel, Field
 
-tavily_client = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
+from tina.retrievers.review_cache import afetch_review, fetch_review
 
 
 class OnlineReviewsInput(BaseModel):
@@ -12,11 +9,16 @@ class OnlineReviewsInput(BaseModel):
 
 
 def online_review(vehicles: str):
-    return tavily_client.search("find feedback about this vehicle from other experts and consumers: "+vehicles)
+    return fetch_review(vehicles)
+
+
+async def aonline_review(vehicles: str):
+    return await afetch_review(vehicles)
 
 
 online_reviews_tool = StructuredTool.from_function(
     func=online_review,
+    coroutine=aonline_review,
     name="online_review",
     description="""
         Useful for searching for online reviews about a vehicle
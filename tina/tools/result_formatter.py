@@ -0,0 +1,48 @@
+import logging
+from typing import Optional
+
+from tina.tools.tool_schema import VehicleSearchResult, VehicleSearchResults
+
+log = logging.getLogger(__name__)
+
+
+def listing_details(metadata: dict) -> list[str]:
+    details = [" ".join(str(metadata[k]) for k in ("year", "make", "model") if metadata.get(k))]
+    if metadata.get("price") is not None:
+        details.append(f"${metadata['price']:,.0f}")
+    if metadata.get("odometer") is not None:
+        details.append(f"{metadata['odometer']:,} km")
+    kind = " ".join(str(metadata[k]) for k in ("fuel", "vehicle_type") if metadata.get(k))
+    if kind:
+        details.append(kind)
+    if metadata.get("seats"):
+        details.append(f"{metadata['seats']} seats")
+    for key in ("drive", "colour"):
+        if metadata.get(key):
+            details.append(metadata[key])
+    if metadata.get("location"):
+        details.append(f"at Turners {metadata['location']}")
+    return [d for d in details if d]
+
+
+def summary_comment(total: int, shown: int) -> str:
+    if total == 0:
+        return "No vehicles matched this search, try widening the year, kms or price range."
+    if total == shown:
+        return f"Found {total} vehicle{'s' if total != 1 else ''} matching this search."
+    return f"Found {total} vehicles matching this search, here are the first {shown}."
+
+
+def format_search_results(listings: list[dict], total: Optional[int] = None,
+                          comments: Optional[str] = None) -> VehicleSearchResults:
+    """build search results straight from listing metadata, no LLM involved"""
+    results = [
+        VehicleSearchResult(
+            source=listing["source"],
+            image=listing.get("image") or listing["metadata"].get("image") or "",
+            listing_details=listing_details(listing["metadata"]),
+        )
+        for listing in listings
+    ]
+    total = len(listings) if total is None else total
+    return VehicleSearchResults(results=results, comments=comments or summary_comment(total, len(results)))
@@ -1,18 +1,17 @@
 import logging
-import os
-import requests
 from dataclasses import dataclass
 from typing import List, Optional
-from math import radians, sin, cos, sqrt, atan2
 from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import StructuredTool
 from tinydb import TinyDB
 from pydantic import BaseModel, Field
 
+from tina.retrievers.branch_index import BranchIndex
+from tina.retrievers.geocode_cache import prefetch_locations
+
 
 log = logging.getLogger(__name__)
 db = TinyDB('db/user.json')
-API_KEY = os.environ["GOOGLE_API_KEY"]
 
 @dataclass
 class TurnersLocation:
@@ -45,72 +44,45 @@ turners_locations = [
 ]
 
 
-def get_location_details(place_id: str) -> tuple:
-    """Get latitude and longitude for a place ID using Google Places API"""
-    url = f"https://maps.googleapis.com/maps/api/place/details/json"
-    params = {
-        "place_id": place_id,
-        "fields": "geometry",
-        "key": API_KEY
-    }
+def user_position(config: RunnableConfig) -> tuple[float, float]:
+    lat = config.get("configurable", {}).get("latitude", -36.90750866841916)
+    lng = config.get("configurable", {}).get("longitude", 174.79082099009818)
+    log.info(f"getting turners locations for lat:{lat}, long:{lng}")
+    return lat, lng
 
-    response = requests.get(url, params=params)
 
-    if response.status_code == 200:
-        result = response.json()
-        if result.get("result") and result["result"].get("geometry"):
-            location = result["result"]["geometry"]["location"]
-            return location["lat"], location["lng"]
-    return None, None
+# any branch without coordinates is resolved once here at startup, never while answering a request
+branch_index = BranchIndex(prefetch_locations(turners_locations))
 
 
 class TurnersGeographyInput(BaseModel):
     config: RunnableConfig = Field(description="runnable config")
     distance: Optional[int] = Field(20, description="max allowed distance to search for turners branches")
+    nearest: Optional[int] = Field(None, description="only return this many of the closest branches, eg 3 for the nearest 3 branches")
 
 
-def turners_geography(config: RunnableConfig, distance: Optional[int] = 20) -> list[str] | None:
-    log.info("in here turners Geography")
-    lat = config.get("configurable", {}).get("latitude", -36.90750866841916)
-    lng = config.get("configurable", {}).get("longitude", 174.79082099009818)
-    log.info(f"getting turners locations for lat:{lat}, long:{lng}")
-
-    for location in turners_locations:
-        if location.lat is None or location.lng is None:
-            location.lat, location.lng = get_location_details(location.place_id)
-            print(f"{location.name}, lat:{location.lat}, lng:{location.lng}")
-
-    def calculate_distance(lat1, lon1, lat2, lon2):
-        """Calculate distance between two points using Haversine formula"""
-        R = 6371  # Earth's radius in kilometers
-
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        _distance = R * c
-
-        return _distance
+def turners_geography(config: RunnableConfig, distance: Optional[int] = 20, nearest: Optional[int] = None) -> list[dict]:
+    lat, lng = user_position(config)
+    if nearest:
+        branches = branch_index.nearest(lat, lng, nearest)
+    else:
+        branches = branch_index.within(lat, lng, distance if distance is not None else 20)
+    return [{"branch": name, "distance_km": round(km, 1)} for name, km in branches]
 
-    # Filter locations within radius
-    nearby_locations = [
-        location.name for location in turners_locations
-        if location.lat is not None
-        and location.lng is not None
-        and calculate_distance(lat, lng, location.lat, location.lng) <= distance
-    ]
 
-    return nearby_locations
+async def aturners_geography(config: RunnableConfig, distance: Optional[int] = 20, nearest: Optional[int] = None) -> list[dict]:
+    # a lookup against in memory arrays, nothing to wait on
+    return turners_geography(config, distance, nearest)
 
 
 turners_geography_tool = StructuredTool.from_function(
     func=turners_geography,
+    coroutine=aturners_geography,
     name="turners_geography",
     description="""
         Used to get turners branches near a user which can be used in subsequent tools to find vehicles.
-        use a value fo 20 as a default distance.
+        Returns the branches sorted by distance, with the distance in km.
+        use a value fo 20 as a default distance, or set nearest (eg 3) to get the closest branches whatever the distance.
         """,
     args_schema=TurnersGeographyInput,
 )
@@ -1,5 +1,4 @@
 import logging
-import os
 from typing import List
 
 from langchain.chat_models import init_chat_model
@@ -9,14 +8,13 @@ from langchain_core.tools import StructuredTool
 from langchain_core.utils.json import parse_json_markdown
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
-from tinydb import Query, TinyDB
-from tavily import TavilyClient
 
+from tina.retrievers.listing_digest import digest_for
+from tina.retrievers.listing_repository import listing_repository
+from tina.retrievers.review_cache import afetch_reviews, fetch_reviews, vehicle_review_keys
 from tina.tools.templates import custom_comparison_template
 
 log = logging.getLogger(__name__)
-db = TinyDB('db/db.json')
-tavily_client = TavilyClient(api_key=os.environ["TAVILY_API_KEY"])
 chat = init_chat_model("gpt-4o", model_provider="openai")
 
 
@@ -42,27 +40,52 @@ class VehicleComparisonOutput(BaseModel):
     vehicle: List[VehicleDetails] = Field(description="list if vehicle details from the comparison")
 
 
-def vehicle_comparison(vehicles: List[VehicleQuery]):
+parser = JsonOutputParser(pydantic_object=VehicleComparisonOutput)
+prompt = PromptTemplate(
+    template=custom_comparison_template,
+    input_variables=["vehicles"],
+    partial_variables={"format_instructions": parser.get_format_instructions()}
+)
+chain = prompt | chat
 
-    q = Query()
-    load_candidates = [db.search(q.source == v.vehicle_source)[0] for v in vehicles]
-    load_reviews = [
-        tavily_client.search("find feedback about this vehicle from other experts and consumers: "+v.vehicle_description)
-        for v in vehicles]
 
-    for (load_candidate, load_review) in zip(load_candidates, load_reviews):
-        load_candidate['reviews'] = load_review
+def load_vehicles(vehicles: List[VehicleQuery]) -> tuple[list[dict], list[tuple[list[str], str]]]:
+    """the listings to compare, and the (review keys, description) of each to look up reviews with"""
+    load_candidates = listing_repository.get_many([v.vehicle_source for v in vehicles])
+    if len(load_candidates) != len(vehicles):
+        raise ValueError("some of the vehicles to compare are no longer in stock")
+    review_queries = [
+        (vehicle_review_keys(v.vehicle_description, c['metadata'].get('make'), c['metadata'].get('model'),
+                             c['metadata'].get('year')), v.vehicle_description)
+        for c, v in zip(load_candidates, vehicles)]
+    return load_candidates, review_queries
 
-    parser = JsonOutputParser(pydantic_object=VehicleComparisonOutput)
-    prompt = PromptTemplate(
-        template=custom_comparison_template,
-        input_variables=["vehicles"],
-        partial_variables={"format_instructions": parser.get_format_instructions()}
-    )
 
-    chain = prompt | chat
+def vehicle_comparison(vehicles: List[VehicleQuery]):
+    load_candidates, review_queries = load_vehicles(vehicles)
+    load_reviews = fetch_reviews(review_queries)
+
+    vehicle_details = [
+        {'vehicle': digest_for(load_candidate), 'reviews': load_review}
+        for (load_candidate, load_review) in zip(load_candidates, load_reviews)
+    ]
     res = chain.invoke({
-        "vehicles": load_candidates
+        "vehicles": vehicle_details
+    })
+    log.info(res.content)
+    return parse_json_markdown(res.content)
+
+
+async def avehicle_comparison(vehicles: List[VehicleQuery]):
+    load_candidates, review_queries = load_vehicles(vehicles)
+    load_reviews = await afetch_reviews(review_queries)
+
+    vehicle_details = [
+        {'vehicle': digest_for(load_candidate), 'reviews': load_review}
+        for (load_candidate, load_review) in zip(load_candidates, load_reviews)
+    ]
+    res = await chain.ainvoke({
+        "vehicles": vehicle_details
     })
     log.info(res.content)
     return parse_json_markdown(res.content)
@@ -70,6 +93,7 @@ def vehicle_comparison(vehicles: List[VehicleQuery]):
 
 vehicle_comparison_tool = StructuredTool.from_function(
     func=vehicle_comparison,
+    coroutine=avehicle_comparison,
     name="vehicle_comparison",
     description="""
         Useful for comparing multiple vehicles
@@ -1,15 +1,22 @@
-import os
-from typing import List, Optional
+import asyncio
+from typing import Annotated, List, Optional
 
 from langchain.chat_models import init_chat_model
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import StructuredTool
 from langchain_core.utils.json import parse_json_markdown
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from tinydb import TinyDB, Query
+from langgraph.prebuilt import InjectedState
+from langchain_openai import ChatOpenAI
+from tina.profile_service import profile_service
+from tina.retrievers.embedding_cache import cached_embeddings
+from tina.retrievers.listing_digest import digest_for
+from tina.retrievers.listing_repository import listing_repository
 from tina.retrievers.query_extractor import QueryExtractor
-from pinecone import Pinecone
+from tina.retrievers.search_criteria import criteria_query
+from tina.retrievers.utils import to_chat_history
+from tina.retrievers.vector_index import get_vector_index
 from pydantic import BaseModel, Field
 
 import logging
@@ -20,53 +27,108 @@ from tina.tools.tool_schema import VehicleSearchResults
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
-db = TinyDB('db/db.json')
-pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENVIRONMENT_REGION"])
-index = pc.Index("turners-sample-stock")
+index = get_vector_index("turners-sample-stock")
 
 
 query_extractor = QueryExtractor()
 chat = init_chat_model("gpt-4o", model_provider="openai")
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large", dimensions=2048)
+embeddings = cached_embeddings(model="text-embedding-3-large", dimensions=2048)
 
 class VehicleSearchInput(BaseModel):
-    chat_history: List[str] = Field(description="the chat history between an ai and human looking for a suitable vehicle")
-    turners_locations: List[str] = Field(description="a list of turners branches where the human is looking for a vehicle.")
+    turners_locations: Optional[List[str]] = Field(None, description="a list of turners branches where the human is looking for a vehicle. leave out to search the branches they chose before.")
+    remember_locations: bool = Field(False, description="true only when the human has chosen these branches themselves, so later searches default to them")
+    messages: Annotated[list, InjectedState("messages")]
+    search_criteria: Annotated[Optional[dict], InjectedState("search_criteria")] = None
+    user_info: Annotated[Optional[dict], InjectedState("user_info")] = None
+    summary: Annotated[Optional[str], InjectedState("summary")] = None
 
 
-def vehicle_search(chat_history: List[str], turners_locations: List[str]) -> str:
-    if turners_locations is None:
-        turners_locations = []
-    if len(turners_locations) > 0:
+prompt = PromptTemplate(
+    template=custom_stuff_template,
+    input_variables=["conversation", "vehicle_descriptions"],
+)
+chain = prompt | chat.with_structured_output(VehicleSearchResults)
+
+
+def search_history(turners_locations: Optional[List[str]], messages: list, search_criteria: Optional[dict],
+                   user_info: Optional[dict] = None, summary: Optional[str] = None) -> tuple[list[str], Optional[dict]]:
+    """the chat history for the prompt, and the query when it is already known from the folded criteria"""
+    chat_history = to_chat_history(messages, summary)
+    # an empty list is a search of every branch, only leaving them out falls back to the saved ones
+    if turners_locations is None and user_info:
+        turners_locations = user_info.get("preferred_branches")
+    if search_criteria:
+        # criteria are folded in turn by turn as the conversation goes, so there is nothing to re-extract here
+        return chat_history, criteria_query(search_criteria, turners_locations or [])
+    if turners_locations:
         chat_history.append(f"ai:the relevant Turners locations to search are {','.join(turners_locations)}")
+    return chat_history, None
 
-    query = query_extractor.extract_query(chat_history)
-    log.info(f"query: {query}")
-    if query is None or len(query) == 0:
-        query = {'query': "any car"}
 
-    vector = embeddings.embed_query(query['query'])
+def remember_branches(config: RunnableConfig, turners_locations: Optional[List[str]]):
+    """branches the user chose become their preferred ones, for searches that don't name any"""
+    user_id = config.get("configurable", {}).get("user_id") if config else None
+    if user_id and turners_locations and profile_service.get(user_id).preferred_branches != turners_locations:
+        profile_service.update(user_id, preferred_branches=turners_locations)
+
+
+def query_index(query: Optional[dict], vector: list[float]) -> list[dict]:
     res = index.query(
         vector=vector,
-        filter=query['filter'],
+        filter=query['filter'] if isinstance(query.get('filter'), dict) else None,
         top_k=5,
         include_metadata=True
     )
-    sources = set(map(lambda x: x['metadata']['source'], res['matches']))
+    sources = list(dict.fromkeys(x['metadata']['source'] for x in res['matches']))
     log.info(f"results: {sources}")
+    return listing_repository.get_many(sources)
 
-    q = Query()
-    load_candidates = [db.search(q.source == src)[0] for src in sources]
 
-    prompt = PromptTemplate(
-        template=custom_stuff_template,
-        input_variables=["conversation", "vehicle_descriptions"],
-    )
-    structured_llm = chat.with_structured_output(VehicleSearchResults)
-    chain = prompt | structured_llm
+def vehicle_search(messages: list, config: RunnableConfig, turners_locations: Optional[List[str]] = None,
+                   remember_locations: bool = False, search_criteria: Optional[dict] = None,
+                   user_info: Optional[dict] = None, summary: Optional[str] = None) -> str:
+    if remember_locations:
+        remember_branches(config, turners_locations)
+    chat_history, query = search_history(turners_locations, messages, search_criteria, user_info, summary)
+    if query is None:
+        query = query_extractor.extract_query(chat_history)
+    log.info(f"query: {query}")
+    if query is None or len(query) == 0:
+        query = {'query': "any car"}
+
+    vector = embeddings.embed_query(query['query'])
+    log.info(f"embedding cache: {embeddings.stats()}")
+    load_candidates = query_index(query, vector)
+
     response: dict | VehicleSearchResults = chain.invoke({
         "conversation": chat_history,
-        "vehicle_descriptions": load_candidates
+        "vehicle_descriptions": [digest_for(c) for c in load_candidates]
+    })
+    log.info(response)
+    return response.model_dump()
+
+
+async def avehicle_search(messages: list, config: RunnableConfig, turners_locations: Optional[List[str]] = None,
+                          remember_locations: bool = False, search_criteria: Optional[dict] = None,
+                          user_info: Optional[dict] = None, summary: Optional[str] = None) -> str:
+    if remember_locations:
+        # only a profile not yet cached has to come off disk
+        await asyncio.to_thread(remember_branches, config, turners_locations)
+    chat_history, query = search_history(turners_locations, messages, search_criteria, user_info, summary)
+    if query is None:
+        query = await query_extractor.aextract_query(chat_history)
+    log.info(f"query: {query}")
+    if query is None or len(query) == 0:
+        query = {'query': "any car"}
+
+    vector = await embeddings.aembed_query(query['query'])
+    log.info(f"embedding cache: {embeddings.stats()}")
+    # the pinecone client is blocking, keep it off the event loop
+    load_candidates = await asyncio.to_thread(query_index, query, vector)
+
+    response: dict | VehicleSearchResults = await chain.ainvoke({
+        "conversation": chat_history,
+        "vehicle_descriptions": [digest_for(c) for c in load_candidates]
     })
     log.info(response)
     return response.model_dump()
@@ -74,6 +136,7 @@ def vehicle_search(chat_history: List[str], turners_locations: List[str]) -> str
 
 vehicle_search_tool = StructuredTool.from_function(
     func=vehicle_search,
+    coroutine=avehicle_search,
     name="vehicle_search",
     description="""
         Useful for finding suitable vehicles that are available based on a chat history between an AI and human.
@@ -91,5 +154,5 @@ if __name__ == '__main__':
         "ai:how about the budget you are working with?",
         "human:under 15k",
     ]
-    vehicle_search(conv, ['Westgate', 'North Shore', 'Otahuhu', 'Penrose', 'Botany', 'Manukau'])
+    vehicle_search(conv, {}, ['Westgate', 'North Shore', 'Otahuhu', 'Penrose', 'Botany', 'Manukau'])
 
@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 from typing import Optional, List
 from langchain_core.tools import StructuredTool
@@ -5,9 +6,9 @@ from tinydb import TinyDB, Query
 from pydantic import BaseModel, Field
 
 from tina.model.watch_list import WatchList
+from tina.retrievers.listing_repository import listing_repository
 
 watchlist_db = TinyDB('db/watch_list.json')
-vehicle_db = TinyDB('db/db.json')
 
 
 class AddToWatchListInput(BaseModel):
@@ -31,6 +32,11 @@ def add_to_watch_list(user_id: str, sources: List[str]):
     return get_watch_list(user_id)
 
 
+async def aadd_to_watch_list(user_id: str, sources: List[str]):
+    # tinydb only does blocking file io
+    return await asyncio.to_thread(add_to_watch_list, user_id, sources)
+
+
 class GetWatchListInput(BaseModel):
     user_id: str = Field("user id of the the user this watch list")
 
@@ -40,17 +46,18 @@ def get_watch_list(user_id: str) -> Optional[dict]:
     result = watchlist_db.search(Q.user_id == user_id)
     if len(result) > 0:
         result_dict = WatchList(**result[0]).dict()
-        vehicle_details = {}
-        for v in result_dict['vehicles']:
-            vehicle_detail = vehicle_db.search(Q.source == v)
-            vehicle_details[v] = vehicle_detail
-
-        result_dict['vehicle_details'] = vehicle_details
+        found = {listing['source']: listing for listing in listing_repository.get_many(result_dict['vehicles'])}
+        result_dict['vehicle_details'] = {v: [found[v]] if v in found else [] for v in result_dict['vehicles']}
         return result_dict
 
 
+async def aget_watch_list(user_id: str) -> Optional[dict]:
+    return await asyncio.to_thread(get_watch_list, user_id)
+
+
 add_to_watch_list_tool = StructuredTool.from_function(
     func=add_to_watch_list,
+    coroutine=aadd_to_watch_list,
     name="add_to_watch_list",
     description="""
         Useful for adding a vehicle to a users watch list.
@@ -60,6 +67,7 @@ add_to_watch_list_tool = StructuredTool.from_function(
 
 get_watch_list_tool = StructuredTool.from_function(
     func=get_watch_list,
+    coroutine=aget_watch_list,
     name="get_watch_list_tool",
     description="""
             Useful for getting a user's watch list